@@ -1,6 +1,59 @@
 import webapp2
-from main import User
-from datetime import timedelta
+import base64
+import csv
+import json
+import StringIO
+import urllib
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from counters import get_counts, set_counts
+from main import (User, V, USER_COUNTERS, app as main_app, devo_source, get_duplicate_count, get_user_counters,
+                  get_version_counter, put_users, split_text)
+from mapper import MapperRun, get_mapper_names, register_mapper, resume_mapper, run_mapper_slice, start_mapper
+from datetime import datetime, timedelta
+from profiling import BUCKETS, SERVICES, WINDOW_MINUTES, get_handler_names, get_metrics
+from utmost import Material
+
+
+RECOUNT_BATCH_SIZE = 1000
+
+PAGE_SIZE = 200
+MAX_PAGE_SIZE = 5000
+EXPORT_FIELDS = ('uid', 'username', 'first_name', 'last_name', 'created', 'last_received', 'last_sent',
+                 'last_auto', 'active', 'group', 'promo', 'version')
+
+
+def encode_page_token(cursor, active, row):
+    # the cursor only resumes the query it came from, so the filter travels with it
+    return base64.urlsafe_b64encode(json.dumps({'c': cursor, 'a': active, 'n': row}))
+
+
+def decode_page_token(token):
+    page = json.loads(base64.urlsafe_b64decode(str(token)))
+    return page['c'], page['a'], page['n']
+
+
+def get_export_row(user):
+    def prep_date(date):
+        return date.isoformat() if date else None
+
+    uid = user.key().name()
+    return (uid, user.username, user.first_name, user.last_name, prep_date(user.created),
+            prep_date(user.last_received), prep_date(user.last_sent), prep_date(user.last_auto),
+            user.active, int(uid) < 0, user.promo, user.version)
+
+
+def to_csv_line(values):
+    def prep(value):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    line = StringIO.StringIO()
+    csv.writer(line).writerow([prep(value) for value in values])
+    return line.getvalue()
 
 
 class AdminPage(webapp2.RequestHandler):
@@ -26,65 +79,241 @@ class AdminPage(webapp2.RequestHandler):
             else:
                 return ''
 
-        offset = int(self.request.get('offset', 0))
-        limit = int(self.request.get('limit', 200))
-        active = int(self.request.get('active', 0))
-        if limit == -1:
-            limit = None
-        if active == 0:
-            active = False
-        else:
-            active = True
+        output = self.request.get('format', 'html')
+        limit = int(self.request.get('limit', PAGE_SIZE))
+        if limit == -1 or limit > MAX_PAGE_SIZE:
+            limit = MAX_PAGE_SIZE
+        token = self.request.get('page')
+        try:
+            if token:
+                cursor, active, row = decode_page_token(token)
+            else:
+                cursor, active, row = None, bool(int(self.request.get('active', 0))), 0
+        except (TypeError, ValueError, KeyError):
+            self.abort(400)
+
         query = User.all()
         if active:
             query.filter('active =', True)
         query.order('-created')
-        self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
-        self.response.write(
-            '<html>\n<head>\n<title>Utmost Bot Admin</title>\n</head>\n<body style="background-color:orange;">\n' +
-            '<table border="1" style="border: 1px solid black; border-collapse: collapse; padding: 10px;">\n')
-        self.response.write('<tr><th>#</th><th>Chat ID</th><th>Name</th>' +
-                            '<th>Created</th><th>Last received</th><th>Last sent</th><th>Last auto</th><th>Active</th><th>Group</th></tr>\n')
-        result = query.run(limit=limit, offset=offset, batch_size=5000)
-        i = 1
-        for user in result:
-            uid = prep_str(user.key().name())
-            name = prep_str(user.first_name)
-            if user.last_name:
-                name += ' ' + prep_str(user.last_name)
-            if user.username:
-                name += ' @' + prep_str(user.username)
-            ctime = prep_date(user.created)
-            rtime = prep_date(user.last_received)
-            stime = prep_date(user.last_sent)
-            atime = prep_date(user.last_auto)
-            active = prep_active(user.active)
-            group = prep_group(uid)
-            self.response.write(('<tr><td>{}</td><td>{}</td><td>{}</td>' +
-                                 '<td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n')
-                                .format(i, uid, name, ctime, rtime, stime, atime, active, group))
-            i += 1
-        self.response.write('</table>\n</body>\n</html>')
+        try:
+            users = query.with_cursor(cursor).fetch(limit)
+        except (db.BadRequestError, db.BadValueError):
+            self.abort(400)
+        next_token = encode_page_token(query.cursor(), active, row + len(users)) if len(users) == limit else None
+        next_url = None
+        if next_token:
+            next_url = '/admin?' + urllib.urlencode({'page': next_token, 'limit': limit, 'format': output})
+
+        # one page is held at most; rows are rendered as the response is written out
+        def html_rows():
+            yield ('<html>\n<head>\n<title>Utmost Bot Admin</title>\n</head>\n<body style="background-color:orange;">\n' +
+                   '<table border="1" style="border: 1px solid black; border-collapse: collapse; padding: 10px;">\n')
+            yield ('<tr><th>#</th><th>Chat ID</th><th>Name</th>' +
+                   '<th>Created</th><th>Last received</th><th>Last sent</th><th>Last auto</th><th>Active</th><th>Group</th></tr>\n')
+            i = row + 1
+            for user in users:
+                uid = prep_str(user.key().name())
+                name = prep_str(user.first_name)
+                if user.last_name:
+                    name += ' ' + prep_str(user.last_name)
+                if user.username:
+                    name += ' @' + prep_str(user.username)
+                ctime = prep_date(user.created)
+                rtime = prep_date(user.last_received)
+                stime = prep_date(user.last_sent)
+                atime = prep_date(user.last_auto)
+                active = prep_active(user.active)
+                group = prep_group(uid)
+                yield (('<tr><td>{}</td><td>{}</td><td>{}</td>' +
+                        '<td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td><td>{}</td></tr>\n')
+                       .format(i, uid, name, ctime, rtime, stime, atime, active, group))
+                i += 1
+            yield '</table>\n'
+            if next_url:
+                yield '<p><a href="{}">Next page</a></p>\n'.format(next_url)
+            yield '</body>\n</html>'
+
+        def json_rows():
+            yield '{"users": ['
+            for i, user in enumerate(users):
+                yield (',' if i else '') + json.dumps(dict(zip(EXPORT_FIELDS, get_export_row(user))))
+            yield '], "next": {}}}'.format(json.dumps(next_token))
+
+        def csv_rows():
+            yield to_csv_line(EXPORT_FIELDS)
+            for user in users:
+                yield to_csv_line(get_export_row(user))
+
+        if next_url:
+            self.response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        if output == 'json':
+            self.response.headers['Content-Type'] = 'application/json; charset=utf-8'
+            self.response.app_iter = json_rows()
+        elif output == 'csv':
+            self.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+            self.response.headers['Content-Disposition'] = 'attachment; filename=users-{}.csv'.format(row)
+            self.response.app_iter = csv_rows()
+        else:
+            self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
+            self.response.app_iter = html_rows()
+
+
+def normalise_last_auto(user):
+    # last_auto marks the Singapore day a daily was last sent, stored as that day's midnight
+    if user.last_auto is None:
+        return False
+    that_day = (user.last_auto + timedelta(hours=8)).date()
+    that_day_time = datetime(that_day.year, that_day.month, that_day.day) - timedelta(hours=8)
+    if user.last_auto == that_day_time:
+        return False
+    user.last_auto = that_day_time
+    return True
+
+
+def resave(entity):
+    # writes every entity back, filling in defaults for newly added properties
+    return True
+
+
+register_mapper('normalise-last-auto', User, normalise_last_auto, put=put_users)
+register_mapper('resave-users', User, resave, put=put_users)
+register_mapper('resave-material', Material, resave)
 
 
 class MigratePage(webapp2.RequestHandler):
     def get(self):
+        job = self.request.get('job')
+        resume = self.request.get('resume')
         self.response.headers['Content-Type'] = 'text/plain'
-        self.response.write('Migrate page: running...')
-        # today = (datetime.utcnow() + timedelta(hours=8)).date()
-        # today_time = datetime(today.year, today.month, today.day) - timedelta(hours=8)
-        # query = User.all()
-        # query.filter('last_auto <', today_time)
-        # for user in query.run(batch_size=1000):
-        #     that_day = (user.last_auto + timedelta(hours=8)).date()
-        #     that_day_time = datetime(that_day.year, that_day.month, that_day.day) - timedelta(hours=8)
-        #     user.last_auto = that_day_time
-        #     user.put()
-        self.response.write(' done!')
-        return
+
+        if job:
+            try:
+                run = start_mapper(job, dry_run=bool(int(self.request.get('dry_run', 0))))
+            except KeyError:
+                self.abort(404)
+            self.response.write('Started {}\n'.format(run.get_run_id()))
+            return
+        if resume:
+            run = resume_mapper(resume)
+            if run is None:
+                self.abort(404)
+            self.response.write('{} {}\n'.format('Resumed' if run.finished is None else 'Already finished',
+                                                  run.get_run_id()))
+            return
+
+        self.response.write('Jobs: {}\n'.format(', '.join(get_mapper_names())))
+        self.response.write('Start with /migrate?job=<job>[&dry_run=1], resume with /migrate?resume=<run>\n\n')
+        for run in MapperRun.all().order('-started').fetch(20):
+            status = 'finished in {}'.format(run.finished - run.started) if run.finished else 'running'
+            self.response.write('{}{} - {} processed, {} changed, {} slice(s), {}\n'.format(
+                run.get_run_id(), ' (dry run)' if run.dry_run else '', run.processed, run.changed, run.slices,
+                status))
+            if run.sample:
+                self.response.write('    e.g. {}\n'.format(', '.join(run.sample)))
+
+    def post(self):
+        run_mapper_slice(self.request.get('run'), int(self.request.get('slice')))
+
+
+class MetricsPage(webapp2.RequestHandler):
+    def get(self):
+        def prep_ms(ms):
+            return '>{}'.format(BUCKETS[-1]) if ms is None else str(ms)
+
+        handlers = get_handler_names(main_app) + get_handler_names(app)
+        self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        self.response.write('Last {} minutes, all instances\n\n'.format(WINDOW_MINUTES))
+        self.response.write('{:<16}{:>9}{:>9}{:>9}{:>9}'.format('Handler', 'Requests', 'p50 ms', 'p90 ms', 'p99 ms'))
+        for service in SERVICES:
+            self.response.write('{:>22}'.format(service + ' ms/req'))
+        self.response.write('{:>14}\n'.format('Cache hits'))
+
+        for summary in get_metrics(handlers):
+            requests = summary['requests']
+            self.response.write('{:<16}{:>9}{:>9}{:>9}{:>9}'.format(
+                summary['handler'], requests, prep_ms(summary['p50']), prep_ms(summary['p90']),
+                prep_ms(summary['p99'])))
+            for service in SERVICES:
+                calls, us = summary['services'][service]
+                self.response.write('{:>22}'.format('{:.1f} ({:.1f} calls)'.format(
+                    us / 1000.0 / requests, calls / float(requests))))
+            lookups = summary['hit'] + summary['miss']
+            hit_rate = '{:.0%}'.format(summary['hit'] / float(lookups)) if lookups else '-'
+            self.response.write('{:>14}\n'.format(hit_rate))
+
+        self.response.write('\nDevo cache (this instance)\n')
+        for tier, counts in sorted(devo_source.get_cache_stats().items()):
+            self.response.write('{} - {} hit / {} miss\n'.format(tier, counts['hit'], counts['miss']))
+        self.response.write('\nDuplicate updates dropped: {}\n'.format(get_duplicate_count()))
+
+
+class StatsPage(webapp2.RequestHandler):
+    def get(self):
+        versions = range(V.get_size())
+        counts = get_counts(list(USER_COUNTERS) + [get_version_counter(version) for version in versions])
+
+        self.response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+        self.response.write('Users: {}\n'.format(counts['users']))
+        self.response.write('Active: {} ({} groups)\n'.format(counts['active'], counts['active-groups']))
+        self.response.write('Groups: {}\n\n'.format(counts['groups']))
+
+        # a daily run sends every chunk of the version's devo to each active subscriber;
+        # chunk counts come from the devo cache only and show as ? until it is warm
+        self.response.write('Expected daily sends per version\n')
+        total = 0
+        for version in versions:
+            letters = V.get_version_letters(version)
+            recipients = counts[get_version_counter(version)]
+            devo = devo_source.peek_devo(delta=0, version=letters)
+            if devo is None:
+                self.response.write('{} - {} subscribers x ? messages\n'.format(letters, recipients))
+                continue
+            messages = len(split_text(devo, markdown=True))
+            total += recipients * messages
+            self.response.write('{} - {} subscribers x {} messages = {}\n'.format(
+                letters, recipients, messages, recipients * messages))
+        self.response.write('Total - {}\n'.format(total))
+
+
+class RecountPage(webapp2.RequestHandler):
+    # rebuilds the counters from the User table, one task per batch carrying the totals so far
+    def get(self):
+        taskqueue.add(url='/recount', params={'run': datetime.now().strftime('%Y%m%d%H%M%S'), 'batch': 0})
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('Recount in progress\n')
+
+    def post(self):
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+        totals = json.loads(self.request.get('totals') or '{}')
+
+        query = User.all()
+        query.with_cursor(self.request.get('cursor') or None)
+        users = query.fetch(RECOUNT_BATCH_SIZE)
+        for user in users:
+            for name in get_user_counters(user):
+                totals[name] = totals.get(name, 0) + 1
+
+        if len(users) == RECOUNT_BATCH_SIZE:
+            try:
+                taskqueue.add(url='/recount', name='recount-{}-{}'.format(run, batch + 1),
+                              params={'run': run, 'batch': batch + 1, 'cursor': query.cursor(),
+                                      'totals': json.dumps(totals)})
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
+            return
+
+        counts = dict((name, 0) for name in USER_COUNTERS)
+        counts.update((get_version_counter(version), 0) for version in range(V.get_size()))
+        counts.update(totals)
+        set_counts(counts)
 
 
 app = webapp2.WSGIApplication([
     ('/admin', AdminPage),
     ('/migrate', MigratePage),
+    ('/metrics', MetricsPage),
+    ('/stats', StatsPage),
+    ('/recount', RecountPage),
 ], debug=True)
@@ -1,3 +1,8 @@
 from google.appengine.ext import vendor
 
-vendor.add('lib')
\ No newline at end of file
+vendor.add('lib')
+
+
+def webapp_add_wsgi_middleware(app):
+    from profiling import ProfilingMiddleware
+    return ProfilingMiddleware(app)
@@ -0,0 +1,346 @@
+# coding=utf-8
+# Offline benchmark for the fetch -> parse -> render -> send pipeline.
+#
+#   python bench.py --sdk ~/google-cloud-sdk/platform/google_appengine --record
+#   python bench.py --sdk ~/google-cloud-sdk/platform/google_appengine
+#
+# --record fetches today's utmost.org page and every version's biblegateway passage once
+# and saves them to the fixture directory; every later run replays those files. App Engine
+# services are the SDK's testbed stubs and Telegram calls are answered locally, so a run
+# never leaves the machine and numbers are comparable between commits.
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import resource
+import sys
+import time
+import types
+import urlparse
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(ROOT, 'bench_fixtures')
+OUTPUT_FILE = os.path.join(ROOT, 'bench_output.txt')
+
+REPEAT = 20
+FANOUT_SIZES = '10000,100000,1000000'
+# fan-outs above this many users are measured on a sample and scaled linearly
+FANOUT_SAMPLE = 20000
+GROUP_EVERY = 20
+TELEGRAM_SEND_RATE = 30
+
+TELEGRAM_RESPONSE = json.dumps({'ok': True, 'result': {}})
+
+STAGE_HEADER = '{:<32}{:>6}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}'
+STAGE_ROW = '{:<32}{:>6}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10}{:>10}'
+FANOUT_HEADER = '{:>10}{:>10}{:>10}{:>10}{:>10}{:>12}{:>10}{:>14}'
+FANOUT_ROW = '{:>10}{:>10}{:>10.2f}{:>10.2f}{:>10.2f}{:>12.2f}{:>10}{:>14}'
+
+
+def setup_sdk(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+    try:
+        import shadow
+    except ImportError:
+        # the bot's secrets are never used offline
+        shadow = types.ModuleType('shadow')
+        shadow.BOT_TOKEN = 'bench'
+        shadow.CREATOR_ID = '0'
+        shadow.BOT_ID = '0'
+        sys.modules['shadow'] = shadow
+
+
+def get_fixture_name(url):
+    parsed = urlparse.urlparse(url)
+    if parsed.netloc.endswith('utmost.org'):
+        return 'utmost.html'
+    if parsed.netloc.endswith('biblegateway.com'):
+        version = urlparse.parse_qs(parsed.query).get('version', ['default'])[0]
+        return 'biblegateway-{}.html'.format(version)
+    return None
+
+
+def make_fetch_stub(fixture_dir, record):
+    from google.appengine.api import urlfetch_service_pb, urlfetch_stub
+    from google.appengine.runtime import apiproxy_errors
+
+    class FixtureFetchStub(urlfetch_stub.URLFetchServiceStub):
+        def _Dynamic_Fetch(self, request, response):
+            url = request.url()
+            if 'api.telegram.org' in url:
+                response.set_statuscode(200)
+                response.set_content(TELEGRAM_RESPONSE)
+                return
+
+            name = get_fixture_name(url)
+            if name is None:
+                raise apiproxy_errors.ApplicationError(urlfetch_service_pb.URLFetchServiceError.INVALID_URL,
+                                                       'No fixture for ' + url)
+            path = os.path.join(fixture_dir, name)
+
+            if record:
+                urlfetch_stub.URLFetchServiceStub._Dynamic_Fetch(self, request, response)
+                with open(path, 'wb') as f:
+                    f.write(response.content())
+                return
+
+            if not os.path.exists(path):
+                raise apiproxy_errors.ApplicationError(urlfetch_service_pb.URLFetchServiceError.FETCH_ERROR,
+                                                       'Missing fixture {}, run with --record first'.format(name))
+            with open(path, 'rb') as f:
+                response.set_content(f.read())
+            response.set_statuscode(200)
+
+    return FixtureFetchStub()
+
+
+def activate_testbed(fixture_dir, record=False):
+    from google.appengine.api import apiproxy_stub_map
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    # daily shards complete in cross-group transactions, which need the HRD policy
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+    bed.init_taskqueue_stub(root_path=ROOT)
+    apiproxy_stub_map.apiproxy.RegisterStub('urlfetch', make_fetch_stub(fixture_dir, record))
+    return bed
+
+
+def get_max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class Bench(object):
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = list()
+        self.fanouts = list()
+
+    def measure(self, name, func, setup=None, repeat=None):
+        # Python 2 has no allocation tracer, so objects left alive by the stage and the
+        # growth in peak RSS stand in for allocations
+        times = list()
+        gc.collect()
+        objects = len(gc.get_objects())
+        rss = get_max_rss()
+        result = None
+        for _ in range(repeat or self.repeat):
+            if setup is not None:
+                setup()
+            start = time.time()
+            result = func()
+            times.append(time.time() - start)
+        gc.collect()
+        self.stages.append((name, times, len(gc.get_objects()) - objects, get_max_rss() - rss))
+        return result
+
+    def report(self):
+        lines = [STAGE_HEADER.format('stage', 'n', 'mean ms', 'p50 ms', 'p95 ms', 'max ms', 'objects', 'rss kb')]
+        for name, times, objects, rss in self.stages:
+            lines.append(STAGE_ROW.format(name, len(times), 1000 * sum(times) / len(times),
+                                          1000 * percentile(times, 0.5), 1000 * percentile(times, 0.95),
+                                          1000 * max(times), objects, rss))
+
+        if self.fanouts:
+            lines.append('')
+            lines.append(FANOUT_HEADER.format('users', 'measured', 'plan s', 'shards s', 'total s',
+                                              'ms/1k users', 'rss kb', 'delivery s'))
+            for size, measured, plan, shards, rss, messages in self.fanouts:
+                scale = float(size) / measured
+                total = (plan + shards) * scale
+                delivery = int(size * messages / TELEGRAM_SEND_RATE)
+                lines.append(FANOUT_ROW.format(size, measured, plan * scale, shards * scale, total,
+                                               1000 * 1000 * total / size, rss, delivery))
+            lines.append('Rows with measured < users are scaled linearly from the sample. Delivery is the')
+            lines.append('floor set by Telegram\'s {} messages/s, not something this run measured.'.format(
+                TELEGRAM_SEND_RATE))
+        return '\n'.join(lines)
+
+
+def clear_devo_caches():
+    import main
+    from google.appengine.api import memcache
+    from google.appengine.ext import db
+    from utmost import Material
+
+    memcache.flush_all()
+    db.delete(list(Material.all(keys_only=True)))
+    main.devo_source.local_cache.entries.clear()
+
+
+def record_fixtures(fixture_dir):
+    import main
+
+    if not os.path.isdir(fixture_dir):
+        os.makedirs(fixture_dir)
+    bed = activate_testbed(fixture_dir, record=True)
+    try:
+        clear_devo_caches()
+        for version_no in range(main.V.get_size()):
+            version = main.V.get_version_letters(version_no)
+            devo = main.get_devo(delta=0, version=version)
+            print('{} {}'.format(version, 'ok' if devo and not devo.startswith('Sorry') else 'FAILED'))
+    finally:
+        bed.deactivate()
+    print('Fixtures saved to ' + fixture_dir)
+
+
+def bench_stages(bench, fixture_dir):
+    import main
+    from utmost import Utmost_Devo_POJO
+
+    source = main.devo_source
+    version = main.V.get_version_letters(0)
+    today_date = source.get_date(0)
+    with open(os.path.join(fixture_dir, 'utmost.html'), 'rb') as f:
+        utmost_html = f.read()
+    with open(os.path.join(fixture_dir, get_fixture_name('https://www.biblegateway.com/?version=' + version)),
+              'rb') as f:
+        passage_html = f.read()
+
+    devo = bench.measure('get_devo (cold)', lambda: main.get_devo(0, version), setup=clear_devo_caches)
+    if not devo or devo.startswith('Sorry') or devo == source.PREPARING:
+        raise SystemExit('get_devo failed on the fixtures: {!r}'.format(devo))
+    bench.measure('get_devo (memcache)', lambda: main.get_devo(0, version),
+                  setup=source.local_cache.entries.clear)
+    bench.measure('get_devo (local)', lambda: main.get_devo(0, version))
+
+    def parse_utmost():
+        source.devo_object = Utmost_Devo_POJO()
+        source._UtmostDevoSource__parse_utmost_org(utmost_html, today_date)
+        return source.devo_object
+
+    devo_object = bench.measure('parse utmost.org', parse_utmost)
+    source._UtmostDevoSource__localise_links(devo_object, version)
+    devo_object.link_to_full_verse_yv = source._UtmostDevoSource__get_youversion_link(
+        verse_ref=devo_object.verse_reference, version=version)
+
+    def parse_passage():
+        source.devo_object = devo_object
+        source._UtmostDevoSource__parse_biblegateway_com(passage_html)
+
+    bench.measure('parse biblegateway', parse_passage)
+    bench.measure('format_to_message', lambda: devo_object.format_to_message(version_abbv=version))
+    bench.measure('render devo', lambda: source._UtmostDevoSource__render_devo(devo_object, version, passage_html))
+    bench.measure('split_text', lambda: main.split_text(devo, markdown=True))
+
+    # every iteration goes to a new chat; lift the global cap so the limiter's bookkeeping is
+    # timed without it sleeping the bench into Telegram's real rate
+    main.limiter.GLOBAL_LIMIT = sys.maxint
+    uids = itertools.count(1)
+    bench.measure('send_message', lambda: main.send_message(next(uids), devo, markdown=True))
+
+    devos = main.get_daily_devos()
+    templates = bench.measure('build_daily_templates', lambda: main.build_daily_templates(devos))
+    bench.measure('render_daily_payload', lambda: [main.render_daily_payload(templates[0], uid)
+                                                   for uid in range(main.DAILY_BATCH_SIZE)])
+    return devos
+
+
+def populate_users(count):
+    import main
+    from google.appengine.ext import db
+
+    yesterday = main.get_today_time() - timedelta(days=1)
+    users = list()
+    for i in range(1, count + 1):
+        uid = -i if i % GROUP_EVERY == 0 else i
+        users.append(main.User(key_name=str(uid), first_name='Bench', version=i % main.V.get_size(),
+                               last_auto=yesterday))
+        if len(users) == main.PUT_BATCH_SIZE:
+            db.put(users)
+            users = list()
+    if users:
+        db.put(users)
+
+
+def bench_fanout(bench, fixture_dir, size, sample, devos):
+    import main
+
+    measured = min(size, sample) if sample else size
+    bed = activate_testbed(fixture_dir)
+    try:
+        populate_users(measured)
+        main.devo_source.local_cache.entries.clear()
+        main.get_daily_devos()
+        gc.collect()
+        rss = get_max_rss()
+
+        start = time.time()
+        if not main.SendPage().run():
+            raise SystemExit('SendPage.run failed for {} users'.format(measured))
+        plan = time.time() - start
+
+        run_id = main.get_daily_run_id()
+        shard_ids = ['{}-{}'.format(run_id, i) for i in range(main.DailyRun.get_by_key_name(run_id).shards)]
+        start = time.time()
+        for shard_id in shard_ids:
+            response = main.app.get_response('/shard', POST={'shard': shard_id})
+            if response.status_int != 200:
+                raise SystemExit('Shard {} failed with {}'.format(shard_id, response.status))
+        shards = time.time() - start
+
+        daily_run = main.DailyRun.get_by_key_name(run_id)
+        if daily_run.sent != measured:
+            raise SystemExit('Daily run sent {} of {} users'.format(daily_run.sent, measured))
+
+        messages = sum(len(main.split_text(devo, markdown=True)) for devo in devos) / float(len(devos))
+        bench.fanouts.append((size, measured, plan, shards, get_max_rss() - rss, messages))
+    finally:
+        bed.deactivate()
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description='Offline benchmark for the daily devo pipeline.')
+    parser.add_argument('--sdk', required=True, help='path to the App Engine Python SDK (google_appengine)')
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help='directory of saved HTML pages')
+    parser.add_argument('--record', action='store_true', help='fetch live pages into the fixture directory')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='iterations per stage')
+    parser.add_argument('--users', default=FANOUT_SIZES, help='comma separated fan-out sizes')
+    parser.add_argument('--sample', type=int, default=FANOUT_SAMPLE,
+                        help='largest fan-out actually run, 0 to run every size in full')
+    parser.add_argument('--output', default=OUTPUT_FILE, help='where to write the report')
+    parser.add_argument('--verbose', action='store_true', help='keep the app\'s info logging')
+    args = parser.parse_args()
+
+    setup_sdk(args.sdk)
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    if args.record:
+        record_fixtures(args.fixtures)
+        return
+
+    bench = Bench(args.repeat)
+    bed = activate_testbed(args.fixtures)
+    try:
+        devos = bench_stages(bench, args.fixtures)
+    finally:
+        bed.deactivate()
+
+    for size in [int(size) for size in args.users.split(',') if size]:
+        bench_fanout(bench, args.fixtures, size, args.sample, devos)
+
+    report = bench.report()
+    print(report)
+    with open(args.output, 'w') as f:
+        f.write(report + '\n')
+
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,70 @@
+import random
+from google.appengine.ext import db
+
+# each counter is split over COUNTER_SHARDS entities so concurrent writers rarely touch the
+# same entity group; an increment picks one shard at random and a read sums all of them
+COUNTER_SHARDS = 20
+
+
+class CounterShard(db.Model):
+    count = db.IntegerProperty(indexed=False, default=0)
+
+
+def get_shard_key(name, shard):
+    return db.Key.from_path('CounterShard', '{}-{}'.format(name, shard))
+
+
+def get_counter_deltas(before, after):
+    deltas = dict()
+    for name in before:
+        deltas[name] = deltas.get(name, 0) - 1
+    for name in after:
+        deltas[name] = deltas.get(name, 0) + 1
+    return dict((name, delta) for name, delta in deltas.items() if delta)
+
+
+def merge_counter_deltas(total, deltas):
+    for name, delta in deltas.items():
+        total[name] = total.get(name, 0) + delta
+    return total
+
+
+def apply_counter_deltas(deltas):
+    # must run inside a cross-group transaction, one entity group per counter touched
+    keys = [get_shard_key(name, random.randrange(COUNTER_SHARDS)) for name in deltas]
+    shards = list()
+    for key, shard in zip(keys, db.get(keys)):
+        if shard is None:
+            shard = CounterShard(key=key)
+        shard.count += deltas[key.name().rsplit('-', 1)[0]]
+        shards.append(shard)
+    db.put(shards)
+
+
+def update_counters(deltas):
+    deltas = dict((name, delta) for name, delta in deltas.items() if delta)
+    if not deltas:
+        return
+    if db.is_in_transaction():
+        apply_counter_deltas(deltas)
+    else:
+        db.run_in_transaction_options(db.create_transaction_options(xg=True), apply_counter_deltas, deltas)
+
+
+def get_counts(names):
+    keys = [get_shard_key(name, shard) for name in names for shard in range(COUNTER_SHARDS)]
+    counts = dict((name, 0) for name in names)
+    for shard in db.get(keys):
+        if shard is not None:
+            counts[shard.key().name().rsplit('-', 1)[0]] += shard.count
+    return counts
+
+
+def set_counts(counts):
+    # overwrites whole counters, e.g. after a recount; increments that land while this
+    # runs can be lost, so it is meant for quiet periods
+    shards = list()
+    for name, count in counts.items():
+        for shard in range(COUNTER_SHARDS):
+            shards.append(CounterShard(key=get_shard_key(name, shard), count=count if shard == 0 else 0))
+    db.put(shards)
@@ -0,0 +1,166 @@
+# coding=utf-8
+MESSAGE_LIMIT = 4096
+
+# break priorities, best first
+BREAK_PARAGRAPH = 3
+BREAK_LINE = 2
+BREAK_SPACE = 1
+BREAK_ANY = 0
+
+ENTITY_CHARS = u'*_`'
+
+
+def utf16_len(char):
+    # Telegram counts message length in UTF-16 code units
+    return 2 if ord(char) > 0xFFFF else 1
+
+
+def split_message(text, limit=MESSAGE_LIMIT, markdown=False):
+    # single pass over the text, remembering the latest break point of each priority that
+    # sits outside any Markdown entity; a chunk is cut at the best one once it is full
+    if isinstance(text, str):
+        if len(text) <= limit:
+            return [text]
+        text = text.decode('utf-8', 'ignore')
+    if len(text) * 2 <= limit:
+        return [text]
+
+    chunks = list()
+    breaks = dict()
+    start = 0
+    start_offset = 0
+    prefix = u''
+    offset = 0
+    entity = None
+    link = None
+    i = 0
+    n = len(text)
+
+    while i < n:
+        char = text[i]
+        outside = entity is None and link is None
+
+        if outside:
+            breaks[BREAK_ANY] = (i, offset)
+
+        width = utf16_len(char)
+        step = 1
+        if markdown and char == u'\\' and outside and i + 1 < n:
+            # an escaped character is never split from its backslash
+            width += utf16_len(text[i + 1])
+            step = 2
+        used = offset - start_offset + len(prefix)
+        if used + width > limit - (1 if entity else 0):
+            cut = None
+            for priority in (BREAK_PARAGRAPH, BREAK_LINE, BREAK_SPACE, BREAK_ANY):
+                candidate = breaks.get(priority)
+                if candidate is None or candidate[0] <= start:
+                    continue
+                # a high-priority break that leaves a tiny chunk is worse than a lower one
+                if priority != BREAK_ANY and (candidate[1] - start_offset) * 2 < limit:
+                    continue
+                cut = candidate
+                break
+
+            if cut is not None:
+                chunks.append(prefix + text[start:cut[0]])
+                start, start_offset = cut
+                prefix = u''
+            else:
+                # no safe break in the whole chunk: close the open entity and reopen it
+                chunks.append(prefix + text[start:i] + (entity or u''))
+                prefix = entity or u''
+                start, start_offset = i, offset
+            for priority in breaks.keys():
+                if breaks[priority][0] <= start:
+                    del breaks[priority]
+            continue
+
+        if not markdown or step == 2:
+            pass
+        elif entity is not None:
+            if char == entity:
+                entity = None
+        elif link == u'text':
+            if char == u']':
+                link = u'url' if text[i + 1:i + 2] == u'(' else None
+        elif link == u'url':
+            if char == u')':
+                link = None
+        elif char in ENTITY_CHARS:
+            entity = char
+        elif char == u'[':
+            link = u'text'
+
+        offset += width
+        i += step
+
+        if entity is None and link is None:
+            if char == u'\n':
+                priority = BREAK_PARAGRAPH if text[i - 2:i - 1] == u'\n' else BREAK_LINE
+                breaks[priority] = (i, offset)
+            elif char == u' ':
+                breaks[BREAK_SPACE] = (i, offset)
+
+    if start < n or prefix:
+        chunks.append(prefix + text[start:])
+    return chunks
+
+
+def escape_markdown(text):
+    # backslash-escape everything Telegram's Markdown would treat as an entity opener
+    return text.replace('*', '\\*').replace('_', '\\_').replace('`', '\\`').replace('[', '\\[')
+
+
+def blank_markdown(text):
+    # for prose where emphasis characters carry no meaning, drop them instead of escaping
+    return text.replace('*', ' ').replace('_', ' ').replace('`', ' ').replace('[', '\\[')
+
+
+def find_unclosed_entity(text):
+    # index of the opener Telegram would reject as unclosed, or None if the text parses
+    entity = None
+    link = None
+    opened = None
+    i = 0
+    n = len(text)
+
+    while i < n:
+        char = text[i]
+        if entity is None and link is None and char == u'\\' and i + 1 < n:
+            i += 2
+            continue
+
+        if entity is not None:
+            if char == entity:
+                entity = None
+        elif link == u'text':
+            if char == u']':
+                link = u'url' if text[i + 1:i + 2] == u'(' else None
+        elif link == u'url':
+            if char == u')':
+                link = None
+        elif char in ENTITY_CHARS:
+            entity = char
+            opened = i
+        elif char == u'[':
+            link = u'text'
+            opened = i
+        i += 1
+
+    if entity is not None or link is not None:
+        return opened
+    return None
+
+
+def is_valid_markdown(text):
+    return find_unclosed_entity(text) is None
+
+
+def sanitise_markdown(text):
+    # escape unclosed openers one at a time until the whole text parses
+    while True:
+        position = find_unclosed_entity(text)
+        if position is None:
+            return text
+        text = text[:position] + u'\\' + text[position:]
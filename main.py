@@ -2,10 +2,15 @@
 import webapp2
 import logging
 import json
-import textwrap
+import threading
+import time
 from google.appengine.api import urlfetch, taskqueue, memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 from datetime import datetime, timedelta
+from counters import get_counter_deltas, merge_counter_deltas, update_counters
+from formatting import is_valid_markdown, split_message
+from ratelimit import RateLimiter, RateLimited
 from utmost import UtmostDevoSource
 from versions import Version
 
@@ -34,6 +39,7 @@ get_devo = devo_source.get_devo
 get_devo_old = devo_source.get_devo_old
 
 V = Version()
+limiter = RateLimiter()
 
 from shadow import BOT_TOKEN, CREATOR_ID, BOT_ID
 
@@ -42,11 +48,22 @@ TELEGRAM_URL_SEND = TELEGRAM_URL + '/sendMessage'
 TELEGRAM_URL_SEND_PHOTO = TELEGRAM_URL + '/sendPhoto'
 TELEGRAM_URL_CHAT_ACTION = TELEGRAM_URL + '/sendChatAction'
 JSON_HEADER = {'Content-Type': 'application/json;charset=utf-8'}
+TASKQUEUE_BATCH_SIZE = 100
+RATE_LIMIT_WAIT = 1
+WEBHOOK_BUDGET = 1
+UPDATE_NAMESPACE = 'updates'
+UPDATE_DEDUP_TIME = 60 * 60
+DUPLICATES_KEY = 'duplicates'
 
 LOG_SENT = '{} {} sent to uid {} ({})'
 LOG_ENQUEUED = 'Enqueued {} to uid {} ({})'
+LOG_ENQUEUED_BATCH = 'Enqueued {} daily message(s) to {} uid(s)'
 LOG_DID_NOT_SEND = 'Did not send {} to uid {} ({}): {}'
 LOG_ERROR_SENDING = 'Error sending {} to uid {} ({}):\n{}'
+LOG_DUPLICATE_UPDATE = 'Dropped duplicate update {} ({} dropped so far)'
+LOG_UPDATE_DEDUP_UNAVAILABLE = 'Could not check update {} for redelivery, handling it'
+LOG_WEBHOOK_SLOW = 'Webhook took {:.2f}s, over budget'
+LOG_RATE_LIMITED = 'Rate limited sending {} to uid {} ({}), retry after {}s'
 LOG_ERROR_DAILY = 'Error enqueueing dailies:\n'
 LOG_ERROR_QUERY = 'Error querying uid {} ({}): {}'
 LOG_TYPE_FEEDBACK = 'Type: Feedback\n'
@@ -60,6 +77,15 @@ LOG_USER_MIGRATED = 'User {} migrated to uid {} ({})'
 LOG_USER_DELETED = 'Deleted uid {} ({})'
 LOG_USER_REACHABLE = 'Uid {} ({}) is still reachable'
 LOG_USER_UNREACHABLE = 'Unable to reach uid {} ({}): {}'
+LOG_DAILY_PLANNED = 'Daily run {} planned with {} shard(s)'
+LOG_DAILY_EXISTS = 'Daily run {} already planned, re-enqueueing unfinished shards'
+LOG_DAILY_SHARD_DONE = 'Daily shard {} finished: {} sent'
+LOG_DAILY_SHARD_SKIPPED = 'Daily shard {} already finished'
+LOG_DAILY_SHARD_SUPERSEDED = 'Daily shard {} generation {} superseded by a resumed run'
+LOG_DAILY_FINISHED = 'Daily run {} finished: {} sent across {} shard(s) in {}'
+LOG_DELIVERED_BATCH = 'Delivered {} daily message(s), {} returned to the queue'
+LOG_DELIVERY_DONE = 'Delivery worker {}-{} found nothing left to send'
+LOG_DELIVERY_ABANDONED = 'Daily run {} abandoned unfinished: {} of {} shards completed, {} sent'
 
 RECOGNISED_ERROR_PARSE = 'Bad Request: Can\'t parse message text'
 RECOGNISED_ERROR_MIGRATE = 'Bad Request: group chat is migrated to a supergroup chat'
@@ -76,18 +102,33 @@ RECOGNISED_ERRORS = ('PEER_ID_INVALID',
                      RECOGNISED_ERROR_MIGRATE)
 
 
+def rate_limit(data, budget=RATE_LIMIT_WAIT):
+    if is_inline_reply_open():
+        # the webhook never sleeps on the limiter; a limited send is queued instead
+        budget = 0
+    limiter.wait(json.loads(data).get('chat_id'), budget)
+
+
+def get_retry_after(response):
+    return response.get('parameters', {}).get('retry_after')
+
+
 def telegram_post(data, deadline=3):
+    rate_limit(data)
     return urlfetch.fetch(url=TELEGRAM_URL_SEND, payload=data, method=urlfetch.POST,
                           headers=JSON_HEADER, deadline=deadline)
 
 
-def telegram_query(uid, deadline=3):
+def telegram_query_async(uid, deadline=3):
     data = json.dumps({'chat_id': uid, 'action': 'typing'})
-    return urlfetch.fetch(url=TELEGRAM_URL_CHAT_ACTION, payload=data, method=urlfetch.POST,
-                          headers=JSON_HEADER, deadline=deadline)
+    rpc = urlfetch.create_rpc(deadline=deadline)
+    urlfetch.make_fetch_call(rpc, url=TELEGRAM_URL_CHAT_ACTION, payload=data, method=urlfetch.POST,
+                             headers=JSON_HEADER)
+    return rpc
 
 
 def telegram_photo(data, deadline=3):
+    rate_limit(data)
     return urlfetch.fetch(url=TELEGRAM_URL_SEND_PHOTO, payload=data, method=urlfetch.POST,
                           headers=JSON_HEADER, deadline=deadline)
 
@@ -98,6 +139,64 @@ def get_today_time():
     return today_time
 
 
+# request-scoped unit of work: while one is open, User setters only mark the entity
+# dirty and a single put per user happens when the handler finishes; every user read
+# during it is kept by uid, so all code in the request changes the same instance
+_user_writes = threading.local()
+PUT_BATCH_SIZE = 500
+# entity groups one cross-group transaction may touch
+XG_ENTITY_GROUPS = 25
+USER_CACHE_TIME = 60 * 60
+# after a user is written its cache entry refuses add for this long, so a read that
+# started before the write cannot put the old entity back
+USER_CACHE_LOCKOUT = 10
+
+
+def begin_user_writes():
+    _user_writes.pending = dict()
+    _user_writes.deletes = dict()
+    _user_writes.tasks = list()
+    _user_writes.loaded = dict()
+
+
+def add_task_after_writes(**kwargs):
+    # tasks that read a user back are only enqueued once the unit of work has written it
+    tasks = getattr(_user_writes, 'tasks', None)
+    if tasks is None:
+        taskqueue.add(**kwargs)
+    else:
+        tasks.append(kwargs)
+
+
+def flush_user_writes():
+    pending = getattr(_user_writes, 'pending', None)
+    deletes = getattr(_user_writes, 'deletes', None)
+    tasks = getattr(_user_writes, 'tasks', None)
+    _user_writes.pending = None
+    _user_writes.deletes = None
+    _user_writes.tasks = None
+    _user_writes.loaded = None
+    if pending:
+        users = pending.values()
+        for i in range(0, len(users), PUT_BATCH_SIZE):
+            put_users(users[i:i + PUT_BATCH_SIZE])
+    if deletes:
+        users = deletes.values()
+        for i in range(0, len(users), PUT_BATCH_SIZE):
+            delete_users(users[i:i + PUT_BATCH_SIZE])
+    for kwargs in tasks or []:
+        taskqueue.add(**kwargs)
+
+
+class UnitOfWorkHandler(webapp2.RequestHandler):
+    def dispatch(self):
+        begin_user_writes()
+        try:
+            super(UnitOfWorkHandler, self).dispatch()
+        finally:
+            flush_user_writes()
+
+
 class User(db.Model):
     username = db.StringProperty(indexed=False)
     first_name = db.StringProperty(multiline=True, indexed=False)
@@ -110,6 +209,11 @@ class User(db.Model):
     promo = db.BooleanProperty(default=False)
     version = db.IntegerProperty(indexed=False, default=0)
 
+    def __init__(self, *args, **kwargs):
+        super(User, self).__init__(*args, **kwargs)
+        # the counters this entity adds to as stored; a new entity adds to none yet
+        self.counted = get_user_counters(self) if kwargs.get('_from_entity') else []
+
     def get_uid(self):
         return self.key().name()
 
@@ -135,98 +239,311 @@ class User(db.Model):
     def is_active(self):
         return self.active
 
+    transient = False
+
+    def put(self, **kwargs):
+        counted = get_user_counters(self)
+        deltas = get_counter_deltas(self.counted, counted)
+
+        def txn():
+            update_counters(deltas)
+            return super(User, self).put(**kwargs)
+
+        if deltas and not db.is_in_transaction():
+            key = db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+        else:
+            key = txn()
+        self.counted = counted
+        uncache_users([self.get_uid()])
+        return key
+
+    def save(self):
+        if self.transient:
+            return
+        pending = getattr(_user_writes, 'pending', None)
+        if pending is None:
+            self.put()
+        else:
+            pending[self.get_uid()] = self
+            _user_writes.loaded[self.get_uid()] = self
+
+    def delete(self, **kwargs):
+        if self.transient:
+            return
+        pending = getattr(_user_writes, 'pending', None)
+        if pending is not None:
+            pending.pop(self.get_uid(), None)
+            _user_writes.loaded.pop(self.get_uid(), None)
+            _user_writes.deletes[self.get_uid()] = self
+            return
+        deltas = get_counter_deltas(self.counted, [])
+
+        def txn():
+            update_counters(deltas)
+            super(User, self).delete(**kwargs)
+
+        if deltas and not db.is_in_transaction():
+            db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+        else:
+            txn()
+        self.counted = []
+        uncache_users([self.get_uid()])
+
     def set_active(self, active):
         self.active = active
-        self.put()
+        self.save()
 
     def set_promo(self, promo):
         self.promo = promo
-        self.put()
+        self.save()
+
+    def set_version(self, version):
+        self.version = version
+        self.save()
+
+    def update_name(self, uname, fname, lname):
+        if (self.username, self.first_name, self.last_name) == (uname, fname, lname):
+            return
+        self.username = uname
+        self.first_name = fname
+        self.last_name = lname
+        self.save()
 
     def update_last_received(self):
         self.last_received = datetime.now()
-        self.put()
+        self.save()
 
     def update_last_sent(self):
         self.last_sent = datetime.now()
-        self.put()
+        self.save()
 
     def update_last_auto(self):
         self.last_auto = get_today_time()
-        self.put()
+        self.save()
 
-    def migrate_to(self, uid):
+    def copy_to(self, uid):
         props = dict((prop, getattr(self, prop)) for prop in self.properties().keys())
         props.update(key_name=str(uid))
-        new_user = User(**props)
-        new_user.put()
-        self.delete()
+        return User(**props)
+
+    def migrate_to(self, uid):
+        # the copy and the delete commit together; this bypasses the unit of work, so any
+        # change to this user still pending there is dropped rather than written back
+        new_user = self.copy_to(uid)
+        deltas = merge_counter_deltas(get_counter_deltas([], get_user_counters(new_user)),
+                                      get_counter_deltas(self.counted, []))
+
+        def txn():
+            update_counters(deltas)
+            db.put(new_user)
+            db.delete(self)
+
+        db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+        new_user.counted = get_user_counters(new_user)
+        self.counted = []
+        pending = getattr(_user_writes, 'pending', None)
+        if pending is not None:
+            pending.pop(self.get_uid(), None)
+            _user_writes.loaded.pop(self.get_uid(), None)
+            _user_writes.loaded[new_user.get_uid()] = new_user
+        uncache_users([self.get_uid(), new_user.get_uid()])
         return new_user
 
 
-def get_user(uid):
-    key = db.Key.from_path('User', str(uid))
-    user = db.get(key)
-    if user == None:
+USER_COUNTERS = ('users', 'groups', 'active', 'active-groups')
+
+
+def get_version_counter(version):
+    return 'version-{}'.format(version)
+
+
+def get_user_counters(user):
+    # every stored user adds one to each counter named here; versions count active users,
+    # which is what a daily run sends to
+    names = ['users']
+    if user.is_group():
+        names.append('groups')
+    if user.active:
+        names.append('active')
+        if user.is_group():
+            names.append('active-groups')
+        names.append(get_version_counter(user.version))
+    return names
+
+
+def get_user_memkey(uid):
+    return 'user-' + str(uid)
+
+
+def uncache_users(uids):
+    memcache.delete_multi([get_user_memkey(uid) for uid in uids], seconds=USER_CACHE_LOCKOUT)
+
+
+def write_counted_users(users, write, deltas):
+    write(users)
+    update_counters(deltas)
+
+
+def write_users(users, get_counted, write):
+    # users whose counters do not move go out in one plain batch; the rest are written
+    # together with their counter shards, in cross-group transactions of as many users
+    # as fit next to the counters they touch
+    plain = list()
+    chunks = list()
+    chunk = list()
+    deltas = dict()
+    for user in users:
+        user_deltas = get_counter_deltas(user.counted, get_counted(user))
+        if not user_deltas:
+            plain.append(user)
+            continue
+        merged = merge_counter_deltas(dict(deltas), user_deltas)
+        if chunk and len(chunk) + 1 + len(merged) > XG_ENTITY_GROUPS:
+            chunks.append((chunk, deltas))
+            chunk = list()
+            merged = dict(user_deltas)
+        chunk.append(user)
+        deltas = merged
+    if chunk:
+        chunks.append((chunk, deltas))
+
+    if plain:
+        write(plain)
+    for chunk, deltas in chunks:
+        if db.is_in_transaction():
+            write_counted_users(chunk, write, deltas)
+        else:
+            db.run_in_transaction_options(db.create_transaction_options(xg=True), write_counted_users, chunk,
+                                          write, deltas)
+    for user in users:
+        user.counted = get_counted(user)
+    uncache_users([user.get_uid() for user in users])
+
+
+def put_users(users):
+    write_users(users, get_user_counters, db.put)
+
+
+def delete_users(users):
+    write_users(users, lambda user: [], db.delete)
+
+
+def find_user(uid):
+    loaded = getattr(_user_writes, 'loaded', None)
+    if loaded is not None:
+        if str(uid) in _user_writes.deletes:
+            return None
+        if str(uid) in loaded:
+            return loaded[str(uid)]
+
+    memkey = get_user_memkey(uid)
+    data = memcache.get(memkey)
+    if data is not None:
+        user = db.model_from_protobuf(entity_pb.EntityProto(data))
+    else:
+        user = db.get(db.Key.from_path('User', str(uid)))
+        if user is not None:
+            memcache.add(memkey, db.model_to_protobuf(user).Encode(), time=USER_CACHE_TIME)
+    if loaded is not None and user is not None:
+        loaded[str(uid)] = user
+    return user
+
+
+def get_user(uid, create=True):
+    user = find_user(uid)
+    if user is None:
         user = User(key_name=str(uid), first_name='-')
-        user.put()
+        if create:
+            user.put()
+            loaded = getattr(_user_writes, 'loaded', None)
+            if loaded is not None:
+                loaded[user.get_uid()] = user
+        else:
+            # stand-in for logging only; save() and delete() leave the datastore alone
+            user.transient = True
     return user
 
 
 def update_profile(uid, uname, fname, lname):
-    existing_user = get_user(uid)
+    existing_user = find_user(uid)
     if existing_user:
-        existing_user.username = uname
-        existing_user.first_name = fname
-        existing_user.last_name = lname
+        existing_user.update_name(uname, fname, lname)
         existing_user.update_last_received()
-        # existing_user.put()
         return existing_user
     else:
         user = User(key_name=str(uid), username=uname, first_name=fname, last_name=lname)
-        user.put()
+        user.save()
         return user
 
 
+def split_text(text, markdown=False):
+    return split_message(text, markdown=markdown)
+
+
+def build_message(uid, text, msg_type='message', force_reply=False, markdown=False,
+                  disable_web_page_preview=False, inline_keyboard=None, reply_to_message_id=False):
+    build = {
+        'chat_id': uid,
+        'text': text.replace('\a', ' ')
+    }
+
+    if force_reply:
+        build['reply_markup'] = {'force_reply': True}
+    elif inline_keyboard:
+        build['reply_markup'] = {'inline_keyboard': inline_keyboard}
+
+    if not reply_to_message_id == False:
+        build['reply_to_message_id'] = reply_to_message_id
+
+    if markdown:
+        build['parse_mode'] = 'Markdown'
+    if msg_type == 'promo' or disable_web_page_preview:
+        build['disable_web_page_preview'] = True
+
+    return build
+
+
+def get_message_task_args(msg_type, data, countdown=0, name=None):
+    payload = json.dumps({
+        'msg_type': msg_type,
+        'data': data
+    })
+    return {'url': '/message', 'payload': payload, 'countdown': countdown, 'name': name}
+
+
+def make_message_task(msg_type, data, countdown=0, name=None):
+    return taskqueue.Task(**get_message_task_args(msg_type, data, countdown=countdown, name=name))
+
+
+def enqueue_tasks(tasks, queue_name='default'):
+    queue = taskqueue.Queue(queue_name)
+    for i in range(0, len(tasks), TASKQUEUE_BATCH_SIZE):
+        try:
+            queue.add(tasks[i:i + TASKQUEUE_BATCH_SIZE])
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            # named tasks left over from an earlier attempt; the rest of the batch is still added
+            pass
+
+
 def send_message(user_or_uid, text, msg_type='message', force_reply=False, markdown=False,
                  disable_web_page_preview=False, inline_keyboard=None, reply_to_message_id=False):
-    if inline_keyboard is None:
-        inline_keyboard = []
     try:
         uid = str(user_or_uid.get_uid())
         user = user_or_uid
     except AttributeError:
         uid = str(user_or_uid)
-        user = get_user(user_or_uid)
+        user = get_user(user_or_uid, create=False)
 
     def send_short_message(text, countdown=0):
-        build = {
-            'chat_id': uid,
-            'text': text.replace('\a', ' ')
-        }
-
-        if force_reply:
-            build['reply_markup'] = {'force_reply': True}
-        elif inline_keyboard:
-            build['reply_markup'] = {'inline_keyboard': inline_keyboard}
-
-        if not reply_to_message_id == False:
-            build['reply_to_message_id'] = reply_to_message_id
-
-        if markdown:
-            build['parse_mode'] = 'Markdown'
-        if msg_type == 'promo' or disable_web_page_preview:
-            build['disable_web_page_preview'] = True
+        build = build_message(uid, text, msg_type=msg_type, force_reply=force_reply, markdown=markdown,
+                              disable_web_page_preview=disable_web_page_preview,
+                              inline_keyboard=inline_keyboard, reply_to_message_id=reply_to_message_id)
 
         data = json.dumps(build)
         logging.debug(data)
 
-        def queue_message():
-            payload = json.dumps({
-                'msg_type': msg_type,
-                'data': data
-            })
-            taskqueue.add(url='/message', payload=payload, countdown=countdown)
+        def queue_message(delay=0):
+            add_task_after_writes(**get_message_task_args(msg_type, data, countdown=countdown + delay))
             logging.info(LOG_ENQUEUED.format(msg_type, uid, user.get_description()))
 
         if msg_type in ('daily', 'promo', 'mass'):
@@ -238,33 +555,152 @@ def send_message(user_or_uid, text, msg_type='message', force_reply=False, markd
             queue_message()
             return
 
-        try:
-            result = telegram_post(data)
-        except Exception as e:
-            logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(), str(e)))
-            queue_message()
+        def post_message():
+            try:
+                result = telegram_post(data)
+            except RateLimited as e:
+                queue_message(int(e.delay) + 1)
+                return
+            except Exception as e:
+                logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(), str(e)))
+                queue_message()
+                return
+
+            response = json.loads(result.content)
+            error_description = str(response.get('description'))
+
+            if error_description.startswith(RECOGNISED_ERROR_PARSE):
+                if build.get('parse_mode'):
+                    del build['parse_mode']
+                queue_message_data(json.dumps(build))
+
+            elif handle_response(response, user, uid, msg_type) == False:
+                queue_message(get_retry_after(response) or 0)
+
+        def queue_message_data(new_data):
+            make_message_task(msg_type, new_data, countdown=countdown).add()
+            logging.info(LOG_ENQUEUED.format(msg_type, uid, user.get_description()))
+
+        if is_inline_reply_open():
+            # the webhook answers with at most one inline reply and queues everything else,
+            # a second behind it so the reply still arrives first
+            if not defer_inline_reply(build, queue_message):
+                queue_message(1)
             return
+        post_message()
+
+    for i, chunk in enumerate(split_text(text, markdown)):
+        send_short_message(chunk, i)
+
+
+def is_duplicate_update(update_id):
+    # Telegram redelivers updates it did not see acknowledged; remember recent update_ids
+    # so a redelivery is dropped before any datastore or network work
+    if update_id is None:
+        return False
+    if memcache.add(str(update_id), True, time=UPDATE_DEDUP_TIME, namespace=UPDATE_NAMESPACE):
+        return False
+    # add also fails when memcache is unavailable; only drop an update we can see was stored
+    if memcache.get(str(update_id), namespace=UPDATE_NAMESPACE) is None:
+        logging.warning(LOG_UPDATE_DEDUP_UNAVAILABLE.format(update_id))
+        return False
+    dropped = memcache.incr(DUPLICATES_KEY, initial_value=0, namespace=UPDATE_NAMESPACE)
+    logging.info(LOG_DUPLICATE_UPDATE.format(update_id, dropped))
+    return True
 
-        response = json.loads(result.content)
-        error_description = str(response.get('description'))
 
-        if error_description.startswith(RECOGNISED_ERROR_PARSE):
-            if build.get('parse_mode'):
-                del build['parse_mode']
-            data = json.dumps(build)
-            queue_message()
+def get_duplicate_count():
+    return memcache.get(DUPLICATES_KEY, namespace=UPDATE_NAMESPACE) or 0
 
-        elif handle_response(response, user, uid, msg_type) == False:
-            queue_message()
 
-    if len(text) > 4096:
-        chunks = textwrap.wrap(text, width=4096, replace_whitespace=False, drop_whitespace=False)
-        i = 0
-        for chunk in chunks:
-            send_short_message(chunk, i)
-            i += 1
-    else:
-        send_short_message(text)
+# inline replies: while a webhook is being handled, its first outgoing message is held
+# back and rides on the webhook's HTTP response instead of an API call; every other
+# message is queued, so the webhook never waits on Telegram. An inline reply gets no
+# result back, so it is only used when the message cannot fail to parse; otherwise that
+# message is queued too, where parse errors and blocked chats are handled
+_inline_reply = threading.local()
+
+
+def open_inline_reply():
+    _inline_reply.open = True
+    _inline_reply.used = False
+    _inline_reply.pending = None
+
+
+def is_inline_reply_open():
+    return getattr(_inline_reply, 'open', False)
+
+
+def defer_inline_reply(build, queue_message):
+    if not is_inline_reply_open() or _inline_reply.used:
+        return False
+    # only the first message may go inline; a later one would overtake anything queued
+    _inline_reply.used = True
+    text = build['text']
+    if isinstance(text, str):
+        text = text.decode('utf-8', 'ignore')
+    if build.get('parse_mode') and not is_valid_markdown(text):
+        return False
+    _inline_reply.pending = (build, queue_message)
+    return True
+
+
+def flush_inline_reply():
+    pending = getattr(_inline_reply, 'pending', None)
+    _inline_reply.pending = None
+    if pending is not None:
+        pending[1]()
+
+
+def close_inline_reply():
+    pending = getattr(_inline_reply, 'pending', None)
+    _inline_reply.open = False
+    _inline_reply.pending = None
+    if pending is None:
+        return None
+    reply = dict(pending[0])
+    reply['method'] = 'sendMessage'
+    return json.dumps(reply)
+
+
+def build_daily_templates(devos):
+    # each version's chunks are serialised once with a placeholder chat_id and split
+    # around it, so per-recipient work is a single join instead of JSON encoding
+    templates = list()
+    placeholder = json.dumps(DAILY_CHAT_ID)
+    for devo in devos:
+        data = [json.dumps(build_message(DAILY_CHAT_ID, chunk, msg_type='daily', markdown=True,
+                                         disable_web_page_preview=True))
+                for chunk in split_text(devo, markdown=True)]
+        templates.append('\n'.join(data).split(placeholder))
+    return templates
+
+
+def render_daily_payload(template, uid):
+    # pull task payload: a '<msg_type> <uid>' header, then one ready-to-post body per line
+    return 'daily {}\n'.format(uid) + json.dumps(uid).join(template)
+
+
+def parse_daily_payload(payload):
+    header, body = payload.split('\n', 1)
+    msg_type, uid = header.split(' ', 1)
+    return msg_type, uid, body.split('\n')
+
+
+def send_daily_batch(users, templates, run_id):
+    # one bulk enqueue per 100 pull tasks and a single multi-entity put for the whole batch;
+    # task names make a retried batch skip messages that were already enqueued
+    today_time = get_today_time()
+    tasks = list()
+    for user in users:
+        uid = str(user.get_uid())
+        payload = render_daily_payload(templates[user.version], uid)
+        tasks.append(taskqueue.Task(payload=payload, method='PULL', name='daily-{}-{}'.format(run_id, uid)))
+        user.last_auto = today_time
+
+    enqueue_tasks(tasks, DELIVERY_QUEUE)
+    put_users(users)
+    logging.info(LOG_ENQUEUED_BATCH.format(len(tasks), len(users)))
 
 
 def handle_response(response, user, uid, msg_type):
@@ -275,6 +711,11 @@ def handle_response(response, user, uid, msg_type):
 
     else:
         error_description = str(response.get('description'))
+        if response.get('error_code') == 429:
+            limiter.penalise(uid, get_retry_after(response) or 1)
+            logging.info(LOG_RATE_LIMITED.format(msg_type, uid, user.get_description(), get_retry_after(response)))
+            return False
+
         if error_description not in RECOGNISED_ERRORS:
             logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(),
                                                      error_description))
@@ -321,7 +762,7 @@ class MainPage(webapp2.RequestHandler):
         self.response.write('Kidding:)\n')
 
 
-class UtmostPage(webapp2.RequestHandler):
+class UtmostPage(UnitOfWorkHandler):
     CMD_LIST = '\n\n' + \
                '/today - get today\'s material\n' + \
                '/yesterday - get yesterday\'s material\n' + \
@@ -468,11 +909,7 @@ class UtmostPage(webapp2.RequestHandler):
             response += self.WELCOME_GET_STARTED
             send_message(user, response)
 
-            send_typing(uid)
-            response = get_devo(version=version_abbrv)
-            if response == None:
-                response = self.REMOTE_ERROR
-            send_message(user, response, markdown=True, disable_web_page_preview=True)
+            self.send_devo(user, 0, version_abbrv)
 
             if new_user:
                 if user.is_group():
@@ -502,28 +939,13 @@ class UtmostPage(webapp2.RequestHandler):
             return cmd == '/' + word or short_cmd.startswith(flexi_pattern)
 
         if is_command_equals('today'):
-            send_typing(uid)
-            response = get_devo(version=version_abbrv)
-            if response is None:
-                response = self.REMOTE_ERROR
-
-            send_message(user, response, markdown=True, disable_web_page_preview=True)
+            self.send_devo(user, 0, version_abbrv)
 
         elif is_command_equals('yesterday') or is_command_equals('yst'):
-            send_typing(uid)
-            response = get_devo(delta=-1, version=version_abbrv)
-            if response is None:
-                response = self.REMOTE_ERROR
-
-            send_message(user, response, markdown=True, disable_web_page_preview=True)
+            self.send_devo(user, -1, version_abbrv)
 
         elif is_command_equals('tomorrow') or is_command_equals('tmr'):
-            send_typing(uid)
-            response = get_devo(delta=1, version=version_abbrv)
-            if response is None:
-                response = self.REMOTE_ERROR
-
-            send_message(user, response, markdown=True, disable_web_page_preview=True)
+            self.send_devo(user, 1, version_abbrv)
 
         elif is_command_equals('subscribe'):
             if user.is_active():
@@ -611,6 +1033,19 @@ class UtmostPage(webapp2.RequestHandler):
 
             send_message(user, response)
 
+    def send_devo(self, user, delta, version_abbrv):
+        # the webhook only answers from cache with a single message; anything that needs
+        # scraping or several chunks is sent from a task so the webhook returns at once
+        send_typing(user.get_uid())
+        response = devo_source.peek_devo(delta=delta, version=version_abbrv)
+        if response is None or len(split_text(response, markdown=True)) > 1:
+            add_task_after_writes(url='/devo',
+                                  params={'uid': user.get_uid(), 'delta': delta, 'version': version_abbrv})
+            logging.info(LOG_ENQUEUED.format('devo', user.get_uid(), user.get_description()))
+            return
+
+        send_message(user, response, markdown=True, disable_web_page_preview=True)
+
     def handle_callback_query(self, callback_query):
         qid = callback_query.get('id')
         data = callback_query.get('data')
@@ -654,8 +1089,7 @@ class UtmostPage(webapp2.RequestHandler):
                 return
 
             elif V.validate_version(new_version_no):
-                user.version = new_version_no
-                user.put()
+                user.set_version(new_version_no)
                 self.answer_callback_query(qid, self.VERSION_UPDATE_SUCCESS_CALLBACK)
 
                 if user.is_group():
@@ -681,6 +1115,24 @@ class UtmostPage(webapp2.RequestHandler):
         data = json.loads(self.request.body)
         logging.debug(self.request.body)
 
+        if is_duplicate_update(data.get('update_id')):
+            return
+
+        started = time.time()
+        open_inline_reply()
+        try:
+            self.handle_update(data)
+        except Exception as e:
+            # acknowledge anyway: a failed update redelivered by Telegram only fails again
+            logging.exception(e)
+        finally:
+            self.send_inline_reply()
+
+        elapsed = time.time() - started
+        if elapsed > WEBHOOK_BUDGET:
+            logging.warning(LOG_WEBHOOK_SLOW.format(elapsed))
+
+    def handle_update(self, data):
         if data.get('message'):
             logging.info('Processing incoming message')
             self.handle_message(data.get('message'))
@@ -695,26 +1147,290 @@ class UtmostPage(webapp2.RequestHandler):
             logging.info(LOG_TYPE_NON_MESSAGE)
             return
 
+    def send_inline_reply(self):
+        if self.response.body:
+            # the response already answers a callback query
+            flush_inline_reply()
+            close_inline_reply()
+            return
+
+        output = close_inline_reply()
+        if output is None:
+            return
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(output)
+        logging.info('Replied inline!')
+        logging.debug(output)
+
+
+DAILY_QUEUE = 'daily'
+DAILY_SHARD_SIZE = 2000
+DAILY_BATCH_SIZE = 500
+DAILY_CHAT_ID = '__chat_id__'
+
+DELIVERY_QUEUE = 'delivery'
+DELIVERY_WORKERS = 3
+DELIVERY_MAX_WAIT = 2
+DELIVERY_BATCH_SIZE = 50
+DELIVERY_LEASE_SECONDS = 60
+DELIVERY_DEADLINE = 10
+DELIVERY_TIME_BUDGET = 8 * 60
+DELIVERY_IDLE_WAIT = 5
+# a run whose shards have not all completed by then, e.g. one that ran out of retries,
+# is given up on so its workers stop polling
+DELIVERY_MAX_RUN_AGE = timedelta(hours=12)
+
+
+class DailyRun(db.Model):
+    shards = db.IntegerProperty(indexed=False, default=0)
+    completed = db.IntegerProperty(indexed=False, default=0)
+    sent = db.IntegerProperty(indexed=False, default=0)
+    started = db.DateTimeProperty(auto_now_add=True, indexed=False)
+    finished = db.DateTimeProperty(indexed=False)
+
+    def get_run_id(self):
+        return self.key().name()
 
-class SendPage(webapp2.RequestHandler):
-    def run(self):
-        query = User.all()
-        query.filter('active =', True)
-        query.filter('last_auto <', get_today_time())
 
-        # TODO CAN BE WORDED BETTER
-        RESPONSE_QN = "In light of this *truths*, how will you live *today* differently?"
+class DailyShard(db.Model):
+    run_id = db.StringProperty(indexed=False)
+    start_cursor = db.TextProperty()
+    end_cursor = db.TextProperty()
+    cursor = db.TextProperty()
+    sent = db.IntegerProperty(indexed=False, default=0)
+    done = db.BooleanProperty(indexed=False, default=False)
+    # bumped whenever the shard is re-enqueued, since a finished task's name stays
+    # tombstoned and only the latest generation may move the shard on
+    generation = db.IntegerProperty(indexed=False, default=0)
 
-        # todo urgent
-        devos = list()
+    def get_shard_id(self):
+        return self.key().name()
 
-        for version_no in range(V.get_size()):
-            devos.append(get_devo(delta=0, version=V.get_version_letters(version_no)))
+
+def get_daily_run_id():
+    return (get_today_time() + timedelta(hours=8)).strftime('%Y-%m-%d')
+
+
+def get_daily_query(keys_only=False):
+    query = User.all(keys_only=keys_only)
+    query.filter('active =', True)
+    query.filter('last_auto <', get_today_time())
+    return query
+
+
+def get_daily_devos():
+    devos = list()
+    for version_no in range(V.get_size()):
+        devos.append(get_devo(delta=0, version=V.get_version_letters(version_no)))
+    return devos
+
+
+def plan_daily_shards(run_id):
+    # walk the index keys-only, cutting a cursor every DAILY_SHARD_SIZE subscribers
+    query = get_daily_query(keys_only=True)
+    cursors = [None]
+    while True:
+        keys = query.with_cursor(cursors[-1]).fetch(DAILY_SHARD_SIZE)
+        if len(keys) < DAILY_SHARD_SIZE:
+            break
+        cursors.append(query.cursor())
+
+    shards = list()
+    for i, start_cursor in enumerate(cursors):
+        end_cursor = cursors[i + 1] if i + 1 < len(cursors) else None
+        shards.append(DailyShard(key_name='{}-{}'.format(run_id, i), run_id=run_id,
+                                 start_cursor=start_cursor, end_cursor=end_cursor))
+    return shards
+
+
+def enqueue_daily_shard(shard):
+    try:
+        taskqueue.add(url='/shard', params={'shard': shard.get_shard_id(), 'generation': shard.generation},
+                      name='daily-{}-{}'.format(shard.get_shard_id(), shard.generation), queue_name=DAILY_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def checkpoint_daily_shard(shard_key, generation, sent, cursor):
+    def txn():
+        shard = db.get(shard_key)
+        if shard.generation != generation:
+            return False
+        shard.sent += sent
+        shard.cursor = cursor
+        shard.put()
+        return True
+
+    return db.run_in_transaction(txn)
+
+
+def enqueue_delivery_worker(run_id, worker, generation=0, countdown=0):
+    name = 'deliver-{}-{}-{}'.format(run_id, worker, generation)
+    try:
+        taskqueue.add(url='/deliver', params={'run': run_id, 'worker': worker, 'generation': generation},
+                      name=name, countdown=countdown, queue_name=DAILY_QUEUE)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def deliver_daily_tasks(queue, tasks):
+    # sends one round of messages concurrently, then any follow-up chunks in later rounds
+    users = dict()
+    pending = list()
+    chunks = dict()
+    for task in tasks:
+        msg_type, uid, data = parse_daily_payload(task.payload)
+        pending.append((task, uid, msg_type, data))
+        chunks[task.name] = len(data)
+    keys = [db.Key.from_path('User', uid) for _, uid, _, _ in pending]
+    for user in db.get(keys):
+        if user is not None:
+            users[user.get_uid()] = user
+
+    done = list()
+    failed = list()
+    deferred = dict()
+    while pending:
+        # send whatever the shared limiter allows now; wait out short delays in-process
+        # and hand anything paused for longer back to the queue until it may go
+        delays = limiter.acquire_many([uid for _, uid, _, _ in pending])
+        ready = list()
+        waiting = list()
+        for item in pending:
+            delay = delays[item[1]]
+            if delay <= 0:
+                ready.append(item)
+            elif delay > DELIVERY_MAX_WAIT:
+                deferred[item[0]] = (item, int(delay) + 1)
+            else:
+                waiting.append(item)
+        if not ready:
+            if waiting:
+                time.sleep(min(delays[item[1]] for item in waiting))
+            pending = waiting
+            continue
+
+        rpcs = list()
+        for task, uid, msg_type, data in ready:
+            rpc = urlfetch.create_rpc(deadline=DELIVERY_DEADLINE)
+            urlfetch.make_fetch_call(rpc, url=TELEGRAM_URL_SEND, payload=data[0], method=urlfetch.POST,
+                                     headers=JSON_HEADER)
+            rpcs.append((rpc, (task, uid, msg_type, data)))
+
+        next_pending = list()
+        for rpc, (task, uid, msg_type, data) in rpcs:
+            user = users.get(uid) or get_user(uid, create=False)
+            try:
+                response = json.loads(rpc.get_result().content)
+            except Exception as e:
+                logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(), str(e)))
+                failed.append(((task, uid, msg_type, data), 0))
+                continue
+
+            error_description = str(response.get('description'))
+            if error_description.startswith(RECOGNISED_ERROR_PARSE) and '"parse_mode"' in data[0]:
+                build = json.loads(data[0])
+                build.pop('parse_mode', None)
+                next_pending.append((task, uid, msg_type, [json.dumps(build)] + data[1:]))
+            elif handle_response(response, user, uid, msg_type) == False:
+                if get_retry_after(response):
+                    deferred[task] = ((task, uid, msg_type, data), get_retry_after(response))
+                else:
+                    failed.append(((task, uid, msg_type, data), 0))
+            elif response.get('ok') and len(data) > 1:
+                next_pending.append((task, uid, msg_type, data[1:]))
+            else:
+                done.append(task)
+        pending = waiting + next_pending
+
+    flush_user_writes()
+    begin_user_writes()
+    # a task that already got some chunks out is replaced by one holding only the rest, so
+    # the next lease does not send those chunks again
+    returned = failed + deferred.values()
+    replacements = list()
+    for (task, uid, msg_type, data), delay in returned:
+        if len(data) < chunks[task.name]:
+            payload = '{} {}\n'.format(msg_type, uid) + '\n'.join(data)
+            replacements.append(taskqueue.Task(payload=payload, method='PULL', countdown=delay))
+            done.append(task)
+        else:
+            # hand the task straight back rather than waiting for its lease to run out
+            queue.modify_task_lease(task, delay)
+    if replacements:
+        queue.add(replacements)
+    if done:
+        queue.delete_tasks(done)
+    logging.info(LOG_DELIVERED_BATCH.format(len(done) - len(replacements), len(returned)))
+
+
+def complete_daily_shard(shard_key):
+    def txn():
+        shard = db.get(shard_key)
+        if shard.done:
+            return None
+        daily_run = DailyRun.get_by_key_name(shard.run_id)
+        shard.done = True
+        daily_run.completed += 1
+        daily_run.sent += shard.sent
+        if daily_run.completed >= daily_run.shards:
+            daily_run.finished = datetime.now()
+        db.put([shard, daily_run])
+        return daily_run
+
+    options = db.create_transaction_options(xg=True)
+    daily_run = db.run_in_transaction_options(options, txn)
+    if daily_run is not None and daily_run.finished is not None:
+        elapsed = daily_run.finished - daily_run.started
+        report = LOG_DAILY_FINISHED.format(daily_run.get_run_id(), daily_run.sent, daily_run.shards, elapsed)
+        logging.info(report)
+        send_message(CREATOR_ID, report)
+
+
+class DevoPage(UnitOfWorkHandler):
+    def post(self):
+        uid = self.request.get('uid')
+        delta = int(self.request.get('delta', 0))
+        user = get_user(uid, create=False)
+
+        response = get_devo(delta=delta, version=self.request.get('version'))
+        if response is None:
+            response = UtmostPage.REMOTE_ERROR
+
+        send_message(user, response, markdown=True, disable_web_page_preview=True)
+
+
+class SendPage(webapp2.RequestHandler):
+    def run(self):
+        run_id = get_daily_run_id()
 
         try:
-            for user in query.run(batch_size=500):
-                send_message(user, devos[user.version], msg_type='daily', markdown=True, disable_web_page_preview=True)
-                # send_message(user, RESPONSE_QN, markdown=True, force_reply=True)
+            daily_run = DailyRun.get_by_key_name(run_id)
+            if daily_run is None:
+                shards = plan_daily_shards(run_id)
+                # the run is written last, so a retry after a partial write plans again
+                for i in range(0, len(shards), PUT_BATCH_SIZE):
+                    db.put(shards[i:i + PUT_BATCH_SIZE])
+                daily_run = DailyRun(key_name=run_id, shards=len(shards))
+                daily_run.put()
+                logging.info(LOG_DAILY_PLANNED.format(run_id, len(shards)))
+            else:
+                logging.info(LOG_DAILY_EXISTS.format(run_id))
+                shard_keys = [db.Key.from_path('DailyShard', '{}-{}'.format(run_id, i))
+                              for i in range(daily_run.shards)]
+                shards = list()
+                for i in range(0, len(shard_keys), PUT_BATCH_SIZE):
+                    shards += [shard for shard in db.get(shard_keys[i:i + PUT_BATCH_SIZE])
+                               if shard and not shard.done]
+                for shard in shards:
+                    shard.generation += 1
+                for i in range(0, len(shards), PUT_BATCH_SIZE):
+                    db.put(shards[i:i + PUT_BATCH_SIZE])
+
+            for shard in shards:
+                enqueue_daily_shard(shard)
+            for worker in range(DELIVERY_WORKERS):
+                enqueue_delivery_worker(run_id, worker)
         except Exception as e:
             logging.warning(LOG_ERROR_DAILY + str(e))
             return False
@@ -730,6 +1446,82 @@ class SendPage(webapp2.RequestHandler):
             self.abort(502)
 
 
+class SendShardPage(webapp2.RequestHandler):
+    def post(self):
+        shard = DailyShard.get_by_key_name(self.request.get('shard'))
+        generation = int(self.request.get('generation', 0))
+        if shard is None or shard.done:
+            logging.info(LOG_DAILY_SHARD_SKIPPED.format(self.request.get('shard')))
+            return
+        if shard.generation != generation:
+            logging.info(LOG_DAILY_SHARD_SUPERSEDED.format(shard.get_shard_id(), generation))
+            return
+
+        devos = get_daily_devos()
+        if None in devos or devo_source.PREPARING in devos:
+            logging.warning(LOG_ERROR_DAILY + 'devo unavailable')
+            self.abort(502)
+        templates = build_daily_templates(devos)
+        query = get_daily_query()
+
+        # resume from the last checkpoint; users already sent to have moved out of the
+        # last_auto range, so a partially processed batch is not sent twice
+        try:
+            while True:
+                query.with_cursor(shard.cursor or shard.start_cursor, shard.end_cursor)
+                users = query.fetch(DAILY_BATCH_SIZE)
+                if users:
+                    send_daily_batch(users, templates, shard.run_id)
+                shard.sent += len(users)
+                shard.cursor = query.cursor()
+                if not checkpoint_daily_shard(shard.key(), generation, len(users), shard.cursor):
+                    logging.info(LOG_DAILY_SHARD_SUPERSEDED.format(shard.get_shard_id(), generation))
+                    return
+                if len(users) < DAILY_BATCH_SIZE:
+                    break
+        except Exception as e:
+            logging.warning(LOG_ERROR_DAILY + str(e))
+            self.abort(502)
+
+        logging.info(LOG_DAILY_SHARD_DONE.format(shard.get_shard_id(), shard.sent))
+        complete_daily_shard(shard.key())
+
+
+class DeliverPage(UnitOfWorkHandler):
+    def post(self):
+        run_id = self.request.get('run')
+        worker = int(self.request.get('worker', 0))
+        generation = int(self.request.get('generation', 0))
+        queue = taskqueue.Queue(DELIVERY_QUEUE)
+        started = time.time()
+
+        while time.time() - started < DELIVERY_TIME_BUDGET:
+            tasks = queue.lease_tasks(DELIVERY_LEASE_SECONDS, DELIVERY_BATCH_SIZE)
+            if tasks:
+                deliver_daily_tasks(queue, tasks)
+                continue
+
+            # nothing leasable only means we are done once every shard has enqueued its users
+            # and no task is left at all; deferred tasks and tasks still leased by a worker
+            # that ran out of time are invisible to lease_tasks but still counted here
+            daily_run = DailyRun.get_by_key_name(run_id)
+            if daily_run is None or (daily_run.finished is not None and queue.fetch_statistics().tasks == 0):
+                logging.info(LOG_DELIVERY_DONE.format(run_id, worker))
+                return
+            if daily_run.finished is None and (run_id != get_daily_run_id() or
+                                               datetime.now() - daily_run.started > DELIVERY_MAX_RUN_AGE):
+                report = LOG_DELIVERY_ABANDONED.format(run_id, daily_run.completed, daily_run.shards,
+                                                       daily_run.sent)
+                logging.warning(report)
+                if worker == 0:
+                    send_message(CREATOR_ID, report)
+                return
+            enqueue_delivery_worker(run_id, worker, generation + 1, countdown=DELIVERY_IDLE_WAIT)
+            return
+
+        enqueue_delivery_worker(run_id, worker, generation + 1)
+
+
 class PromoPage(webapp2.RequestHandler):
     def get(self):
         taskqueue.add(url='/promo', method="POST")
@@ -750,16 +1542,20 @@ class PromoPage(webapp2.RequestHandler):
             send_message(user, promo_msg, msg_type='promo', markdown=True)
 
 
-class MessagePage(webapp2.RequestHandler):
+class MessagePage(UnitOfWorkHandler):
     def post(self):
         params = json.loads(self.request.body)
         msg_type = params.get('msg_type')
         data = params.get('data')
         uid = str(json.loads(data).get('chat_id'))
-        user = get_user(uid)
+        user = get_user(uid, create=False)
 
         try:
             result = telegram_post(data, 4)
+        except RateLimited as e:
+            # delay rather than fail, so the single queue retry is kept for real errors
+            make_message_task(msg_type, data, countdown=int(e.delay) + 1).add()
+            return
         except Exception as e:
             logging.warning(LOG_ERROR_SENDING.format(msg_type, uid, user.get_description(), str(e)))
             logging.debug(data)
@@ -768,6 +1564,10 @@ class MessagePage(webapp2.RequestHandler):
         response = json.loads(result.content)
 
         if handle_response(response, user, uid, msg_type) == False:
+            retry_after = get_retry_after(response)
+            if retry_after:
+                make_message_task(msg_type, data, countdown=retry_after).add()
+                return
             logging.debug(data)
             self.abort(502)
 
@@ -799,21 +1599,25 @@ class MassPage(webapp2.RequestHandler):
 class CachePage(webapp2.RequestHandler):
     def get(self):
         logging.debug("Caching devos for today.")
-        memcache.flush_all()
+        generation = devo_source.get_generation() + 1
 
         status = "Status : "
 
         try:
             # cache only today and tmr
-            for delta in range(0, 2):
-                for version in range(V.get_size()):
-                    logging.debug("how many times {}".format(version))
-                    get_devo(delta=delta, version=V.get_version_letters(version))
+            versions = [V.get_version_letters(version) for version in range(V.get_size())]
+            report = devo_source.warm_cache(deltas=range(0, 2), versions=versions, generation=generation)
+            devo_source.set_generation(generation)
         except Exception as e:
             status += "Cache Failed - " + str(e)
 
         else:
-            status += "Cache Passed: "
+            failed = len([item for item in report if item[1].startswith('failed')])
+            status += "Cache Passed: " if failed == 0 else "Cache Failed ({}/{}): ".format(failed, len(report))
+            for memkey, item_status in report:
+                status += "\n{} - {}".format(memkey, item_status)
+            for tier, counts in sorted(devo_source.get_cache_stats().items()):
+                status += "\n{} cache - {} hit / {} miss".format(tier, counts['hit'], counts['miss'])
         finally:
             send_message(CREATOR_ID, status)
             self.response.write("Success...")
@@ -821,52 +1625,112 @@ class CachePage(webapp2.RequestHandler):
         return
 
 
-class VerifyPage(webapp2.RequestHandler):
-    def get(self):
-        try:
-            query = User.all()
-            query.filter('active =', False)
-            for user in query.run(batch_size=3000):
-                uid = str(user.get_uid())
-                taskqueue.add(url='/verify', payload=uid)
-            self.response.headers['Content-Type'] = 'text/plain'
-            self.response.write('Cleanup in progress\n')
-        except Exception as e:
-            logging.error(e)
+VERIFY_BATCH_SIZE = 100
+VERIFY_DEADLINE = 4
+VERIFY_MAX_WAIT = 2
+
+LOG_VERIFIED_BATCH = 'Verified {} inactive uid(s): {} reachable, {} migrated, {} deleted, {} skipped'
+
+
+def verify_users(users):
+    # probes every user at once within the shared rate limit, then applies all migrations
+    # and deletions in one batched put and delete; returns how many were still reachable
+    users = dict((user.get_uid(), user) for user in users)
+    pending = users.keys()
+    reachable = 0
+    skipped = 0
+    migrated = list()
+    deleted = list()
+
+    while pending:
+        delays = limiter.acquire_many(pending)
+        ready = [uid for uid in pending if delays[uid] <= 0]
+        waiting = [uid for uid in pending if 0 < delays[uid] <= VERIFY_MAX_WAIT]
+        # anything paused for longer is left for the next verification run
+        skipped += len(pending) - len(ready) - len(waiting)
+        if not ready:
+            if waiting:
+                time.sleep(min(delays[uid] for uid in waiting))
+            pending = waiting
+            continue
+
+        rpcs = [(telegram_query_async(uid, VERIFY_DEADLINE), uid) for uid in ready]
+        retry = list()
+        for rpc, uid in rpcs:
+            user = users[uid]
+            try:
+                response = json.loads(rpc.get_result().content)
+            except Exception as e:
+                logging.warning(LOG_ERROR_QUERY.format(uid, user.get_description(), str(e)))
+                skipped += 1
+                continue
+
+            if response.get('ok'):
+                logging.info(LOG_USER_REACHABLE.format(uid, user.get_description()))
+                reachable += 1
+                continue
 
-    def post(self):
-        uid = self.request.body
-        user = get_user(uid)
-
-        try:
-            result = telegram_query(uid, 4)
-        except Exception as e:
-            logging.warning(LOG_ERROR_QUERY.format(uid, user.get_description(), str(e)))
-            self.abort(502)
-
-        response = json.loads(result.content)
-        if response.get('ok'):
-            logging.info(LOG_USER_REACHABLE.format(uid, user.get_description()))
-        else:
             error_description = str(response.get('description'))
-            if error_description == RECOGNISED_ERROR_MIGRATE:
+            if response.get('error_code') == 429:
+                retry_after = get_retry_after(response) or 1
+                limiter.penalise(uid, retry_after)
+                if retry_after <= VERIFY_MAX_WAIT:
+                    retry.append(uid)
+                else:
+                    skipped += 1
+            elif error_description == RECOGNISED_ERROR_MIGRATE and \
+                    response.get('parameters', {}).get('migrate_to_chat_id'):
                 new_uid = response.get('parameters', {}).get('migrate_to_chat_id')
-                if new_uid:
-                    user = user.migrate_to(new_uid)
-                    logging.info(LOG_USER_MIGRATED.format(uid, new_uid, user.get_description()))
+                migrated.append((user, user.copy_to(new_uid)))
+                logging.info(LOG_USER_MIGRATED.format(uid, new_uid, user.get_description()))
             elif error_description in RECOGNISED_ERRORS:
-                user_description = user.get_description()
-                user.delete()
-                logging.info(LOG_USER_DELETED.format(uid, user_description))
+                deleted.append(user)
+                logging.info(LOG_USER_DELETED.format(uid, user.get_description()))
             else:
                 logging.warning(LOG_USER_UNREACHABLE.format(uid, user.get_description(), error_description))
-                self.abort(502)
+                skipped += 1
+        pending = waiting + retry
+
+    if migrated:
+        put_users([new_user for _, new_user in migrated])
+    if migrated or deleted:
+        delete_users([user for user, _ in migrated] + deleted)
+    logging.info(LOG_VERIFIED_BATCH.format(len(users), reachable, len(migrated), len(deleted), skipped))
+
+
+class VerifyPage(UnitOfWorkHandler):
+    # pages through inactive users with a cursor, one task per batch
+    def get(self):
+        taskqueue.add(url='/verify', params={'run': datetime.now().strftime('%Y%m%d%H%M%S'), 'batch': 0})
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write('Cleanup in progress\n')
+
+    def post(self):
+        run = self.request.get('run')
+        batch = int(self.request.get('batch'))
+
+        query = User.all()
+        query.filter('active =', False)
+        query.with_cursor(self.request.get('cursor') or None)
+        users = query.fetch(VERIFY_BATCH_SIZE)
+        if users:
+            verify_users(users)
+
+        if len(users) == VERIFY_BATCH_SIZE:
+            try:
+                taskqueue.add(url='/verify', name='verify-{}-{}'.format(run, batch + 1),
+                              params={'run': run, 'batch': batch + 1, 'cursor': query.cursor()})
+            except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+                pass
 
 
 app = webapp2.WSGIApplication([
     ('/', MainPage),
     ('/' + BOT_TOKEN, UtmostPage),
+    ('/devo', DevoPage),
     ('/send', SendPage),
+    ('/shard', SendShardPage),
+    ('/deliver', DeliverPage),
     ('/message', MessagePage),
     ('/promo', PromoPage),
     ('/mass', MassPage),
@@ -0,0 +1,108 @@
+import logging
+from datetime import datetime
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+# runs a registered function over every entity of a kind, one task per slice; a slice
+# reads from the run's cursor, saves what changed in one batch and commits its progress
+# together with the task for the next slice, so a failed slice is simply retried
+MAPPER_URL = '/migrate'
+MAPPER_BATCH_SIZE = 200
+MAPPER_SAMPLE_SIZE = 20
+
+LOG_MAPPER_STARTED = 'Mapper run {} started{}'
+LOG_MAPPER_SLICE = 'Mapper run {} slice {}: {} processed, {} changed'
+LOG_MAPPER_STALE = 'Mapper run {} slice {} already done'
+LOG_MAPPER_FINISHED = 'Mapper run {} finished: {} processed, {} changed in {}'
+
+_mappers = dict()
+
+
+def register_mapper(name, model, func, put=db.put):
+    # func changes an entity in place and returns True if it needs saving; it must leave
+    # an already changed entity alone, since a retried slice sees its own earlier writes
+    _mappers[name] = (model, func, put)
+
+
+def get_mapper_names():
+    return sorted(_mappers.keys())
+
+
+class MapperRun(db.Model):
+    job = db.StringProperty(indexed=False)
+    dry_run = db.BooleanProperty(indexed=False, default=False)
+    cursor = db.TextProperty()
+    slices = db.IntegerProperty(indexed=False, default=0)
+    processed = db.IntegerProperty(indexed=False, default=0)
+    changed = db.IntegerProperty(indexed=False, default=0)
+    sample = db.StringListProperty(indexed=False)
+    started = db.DateTimeProperty(auto_now_add=True)
+    finished = db.DateTimeProperty(indexed=False)
+
+    def get_run_id(self):
+        return self.key().name()
+
+
+def enqueue_mapper_slice(run, transactional=False):
+    taskqueue.add(url=MAPPER_URL, params={'run': run.get_run_id(), 'slice': run.slices},
+                  transactional=transactional)
+
+
+def start_mapper(job, dry_run=False):
+    if job not in _mappers:
+        raise KeyError(job)
+    run = MapperRun(key_name='{}-{}'.format(job, datetime.now().strftime('%Y%m%d%H%M%S')), job=job,
+                    dry_run=dry_run)
+    run.put()
+    enqueue_mapper_slice(run)
+    logging.info(LOG_MAPPER_STARTED.format(run.get_run_id(), ' (dry run)' if dry_run else ''))
+    return run
+
+
+def resume_mapper(run_id):
+    # restarts a chain whose task was dropped, from the last slice that committed
+    run = MapperRun.get_by_key_name(run_id)
+    if run is not None and run.finished is None:
+        enqueue_mapper_slice(run)
+    return run
+
+
+def run_mapper_slice(run_id, slice_no):
+    run = MapperRun.get_by_key_name(run_id)
+    if run is None or run.finished is not None or run.slices != slice_no:
+        logging.info(LOG_MAPPER_STALE.format(run_id, slice_no))
+        return
+
+    model, func, put = _mappers[run.job]
+    query = model.all()
+    query.with_cursor(run.cursor)
+    entities = query.fetch(MAPPER_BATCH_SIZE)
+    changed = [entity for entity in entities if func(entity)]
+    if changed and not run.dry_run:
+        put(changed)
+    cursor = query.cursor()
+
+    def txn():
+        current = MapperRun.get_by_key_name(run_id)
+        if current.slices != slice_no:
+            return None
+        current.cursor = cursor
+        current.slices += 1
+        current.processed += len(entities)
+        current.changed += len(changed)
+        room = MAPPER_SAMPLE_SIZE - len(current.sample)
+        current.sample += [str(entity.key().id_or_name()) for entity in changed[:max(room, 0)]]
+        if len(entities) < MAPPER_BATCH_SIZE:
+            current.finished = datetime.now()
+        else:
+            enqueue_mapper_slice(current, transactional=True)
+        current.put()
+        return current
+
+    run = db.run_in_transaction(txn)
+    if run is None:
+        logging.info(LOG_MAPPER_STALE.format(run_id, slice_no))
+        return
+    logging.info(LOG_MAPPER_SLICE.format(run_id, slice_no, len(entities), len(changed)))
+    if run.finished is not None:
+        logging.info(LOG_MAPPER_FINISHED.format(run_id, run.processed, run.changed, run.finished - run.started))
@@ -0,0 +1,134 @@
+# coding=utf-8
+# Checks the lxml parsers in utmost.py against output recorded from the BeautifulSoup
+# implementation they replaced.
+#
+#   python parse_check.py --sdk ~/google-cloud-sdk/platform/google_appengine
+#   python parse_check.py --sdk ~/google-cloud-sdk/platform/google_appengine --record
+#
+# parse_fixtures/ holds a utmost.org page (utmost.html) and biblegateway passages
+# (biblegateway-<version>.html), named the way bench.py --record saves them, next to what
+# the BeautifulSoup parsers made of them: the devo fields in utmost.json and each rendered
+# passage in biblegateway-<version>.txt. Any difference is printed and the script exits
+# non-zero.
+#
+# --record rewrites the recorded output by running the BeautifulSoup parsers from
+# BS4_REVISION over the pages; it needs beautifulsoup4 importable. To check against fresh
+# pages, copy bench_fixtures/*.html over the ones here and record again.
+import argparse
+import glob
+import io
+import json
+import os
+import subprocess
+import sys
+import types
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(ROOT, 'parse_fixtures')
+
+# the last utmost.py that parsed both sites with BeautifulSoup
+BS4_REVISION = 'd2b91dc~1'
+
+# the recorded devo was parsed on this day, which only shows up in its date field
+FIXTURE_DATE = datetime(2026, 10, 18)
+UTMOST_FIELDS = ('date', 'heading', 'verse_concise', 'verse_reference', 'post', 'bible_in_a_year',
+                 'link_to_full_verse_bgw')
+
+
+def setup_sdk(sdk_path):
+    sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, ROOT)
+
+
+def load_bs4_parser():
+    source = subprocess.check_output(['git', 'show', BS4_REVISION + ':utmost.py'], cwd=ROOT)
+    module = types.ModuleType('utmost_bs4')
+    exec compile(source, 'utmost.py@' + BS4_REVISION, 'exec') in module.__dict__
+    return module
+
+
+def read_page(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def get_passage_pages(fixture_dir):
+    pages = dict()
+    for path in sorted(glob.glob(os.path.join(fixture_dir, 'biblegateway-*.html'))):
+        version = os.path.basename(path)[len('biblegateway-'):-len('.html')]
+        pages[version] = path
+    return pages
+
+
+def parse_pages(module, fixture_dir):
+    # returns the devo fields and the rendered passage per version that module's parsers produce
+    source = module.UtmostDevoSource()
+    source.devo_object = module.Utmost_Devo_POJO()
+    source._UtmostDevoSource__parse_utmost_org(read_page(os.path.join(fixture_dir, 'utmost.html')),
+                                               FIXTURE_DATE)
+    fields = dict((field, getattr(source.devo_object, field, None)) for field in UTMOST_FIELDS)
+
+    passages = dict()
+    for version, path in get_passage_pages(fixture_dir).items():
+        devo_object = module.Utmost_Devo_POJO()
+        devo_object.link_to_full_verse_yv = None
+        devo_object.link_to_full_verse_bgw = fields['link_to_full_verse_bgw']
+        source.devo_object = devo_object
+        source._UtmostDevoSource__parse_biblegateway_com(read_page(path))
+        passages[version] = devo_object.verse_full
+    return fields, passages
+
+
+def record(fixture_dir):
+    fields, passages = parse_pages(load_bs4_parser(), fixture_dir)
+    with io.open(os.path.join(fixture_dir, 'utmost.json'), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(fields, indent=2, sort_keys=True, ensure_ascii=False) + u'\n')
+    for version, passage in passages.items():
+        with io.open(os.path.join(fixture_dir, 'biblegateway-{}.txt'.format(version)), 'w', encoding='utf-8') as f:
+            f.write(passage + u'\n')
+    print('recorded BeautifulSoup output for utmost.html and {} passage(s)'.format(len(passages)))
+
+
+def check(fixture_dir):
+    import utmost
+
+    fields, passages = parse_pages(utmost, fixture_dir)
+    with io.open(os.path.join(fixture_dir, 'utmost.json'), encoding='utf-8') as f:
+        expected = json.loads(f.read())
+
+    mismatches = list()
+    for field in UTMOST_FIELDS:
+        if fields[field] != expected[field]:
+            mismatches.append((field, expected[field], fields[field]))
+    for version, passage in sorted(passages.items()):
+        with io.open(os.path.join(fixture_dir, 'biblegateway-{}.txt'.format(version)), encoding='utf-8') as f:
+            recorded = f.read().rstrip(u'\n')
+        if passage != recorded:
+            mismatches.append(('verse_full ' + version, recorded, passage))
+
+    for name, recorded, actual in mismatches:
+        print('{} differs\n  recorded: {!r}\n  lxml:     {!r}'.format(name, recorded, actual))
+    if mismatches:
+        sys.exit(1)
+    print('utmost.html and {} passage(s) match the recorded BeautifulSoup output'.format(len(passages)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the lxml page parsers with recorded BeautifulSoup output.')
+    parser.add_argument('--sdk', required=True, help='path to the App Engine Python SDK (google_appengine)')
+    parser.add_argument('--fixtures', default=FIXTURE_DIR, help='directory of saved pages and recorded output')
+    parser.add_argument('--record', action='store_true', help='record the BeautifulSoup output for the pages')
+    args = parser.parse_args()
+
+    setup_sdk(os.path.expanduser(args.sdk))
+    if args.record:
+        record(args.fixtures)
+    else:
+        check(args.fixtures)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import logging
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map, memcache
+
+# per-request RPC timings are gathered through apiproxy hooks and added to per-minute
+# memcache counters in one offset_multi when the request ends, so every instance feeds
+# the same rolling window; latencies go into fixed buckets and percentiles are read off
+# the bucket counts
+NAMESPACE = 'profiling'
+WINDOW_MINUTES = 15
+SERVICES = ('urlfetch', 'datastore_v3', 'memcache')
+
+# request latency bucket upper bounds, in ms
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+
+# limiter windows and pause flags are expected to miss; they say nothing about caching
+IGNORED_NAMESPACES = ('ratelimit', NAMESPACE)
+
+LOG_ERROR_PROFILING = 'Error recording request metrics:\n'
+
+_profile = threading.local()
+
+
+def pre_call_hook(service, call, request, response):
+    if getattr(_profile, 'record', None) is None or service not in SERVICES:
+        return
+    _profile.started[id(response)] = time.time()
+
+
+def post_call_hook(service, call, request, response):
+    record = getattr(_profile, 'record', None)
+    if record is None or service not in SERVICES:
+        return
+    started = _profile.started.pop(id(response), None)
+    if started is not None:
+        calls = record['calls'].setdefault(service, [0, 0])
+        calls[0] += 1
+        calls[1] += int((time.time() - started) * 1000000)
+    if service == 'memcache' and call == 'Get' and request.name_space() not in IGNORED_NAMESPACES:
+        hits = response.item_size()
+        record['hit'] += hits
+        record['miss'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('profiling', pre_call_hook)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('profiling', post_call_hook)
+
+
+def get_bucket(ms):
+    for i, bound in enumerate(BUCKETS):
+        if ms <= bound:
+            return i
+    return len(BUCKETS)
+
+
+def get_metric_key(handler, minute, name):
+    return '{}-{}-{}'.format(handler, minute, name)
+
+
+def get_handler_name(app, environ):
+    try:
+        route = app.router.match(app.request_class(environ))[0]
+        return getattr(route.handler, '__name__', str(route.handler))
+    except Exception:
+        return 'unrouted'
+
+
+def get_handler_names(app):
+    return [getattr(route.handler, '__name__', str(route.handler)) for route in app.router.match_routes]
+
+
+class ProfilingMiddleware(object):
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        _profile.record = {'calls': dict(), 'hit': 0, 'miss': 0}
+        _profile.started = dict()
+        start = time.time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            elapsed = time.time() - start
+            record = _profile.record
+            _profile.record = None
+            _profile.started = None
+            self.save(get_handler_name(self.app, environ), elapsed, record)
+
+    def save(self, handler, elapsed, record):
+        minute = int(time.time() // 60)
+        deltas = {get_metric_key(handler, minute, 't{}'.format(get_bucket(elapsed * 1000))): 1}
+        for service, (count, us) in record['calls'].items():
+            deltas[get_metric_key(handler, minute, service + '-calls')] = count
+            deltas[get_metric_key(handler, minute, service + '-us')] = us
+        if record['hit']:
+            deltas[get_metric_key(handler, minute, 'hit')] = record['hit']
+        if record['miss']:
+            deltas[get_metric_key(handler, minute, 'miss')] = record['miss']
+        try:
+            # create the minute's keys with an expiry first, so counters outside the window
+            # fall out of memcache instead of piling up
+            memcache.add_multi(dict((key, 0) for key in deltas), time=(WINDOW_MINUTES + 1) * 60,
+                               namespace=NAMESPACE)
+            memcache.offset_multi(deltas, namespace=NAMESPACE)
+        except Exception as e:
+            logging.warning(LOG_ERROR_PROFILING + str(e))
+
+
+def get_percentile(buckets, fraction):
+    total = sum(buckets)
+    if total == 0:
+        return None
+    seen = 0
+    for i, count in enumerate(buckets):
+        seen += count
+        if seen >= total * fraction:
+            return BUCKETS[i] if i < len(BUCKETS) else None
+    return None
+
+
+def get_metrics(handlers):
+    # one get_multi over the whole window; returns a summary per handler, busiest first
+    handlers = sorted(set(handlers))
+    minute = int(time.time() // 60)
+    minutes = range(minute - WINDOW_MINUTES + 1, minute + 1)
+    names = ['t{}'.format(i) for i in range(len(BUCKETS) + 1)] + ['hit', 'miss']
+    for service in SERVICES:
+        names += [service + '-calls', service + '-us']
+    keys = [get_metric_key(handler, m, name) for handler in handlers for m in minutes for name in names]
+    cached = memcache.get_multi(keys, namespace=NAMESPACE)
+
+    def total(handler, name):
+        return sum(int(cached.get(get_metric_key(handler, m, name), 0)) for m in minutes)
+
+    metrics = list()
+    for handler in handlers:
+        buckets = [total(handler, 't{}'.format(i)) for i in range(len(BUCKETS) + 1)]
+        requests = sum(buckets)
+        if requests == 0:
+            continue
+        summary = {'handler': handler, 'requests': requests, 'hit': total(handler, 'hit'),
+                   'miss': total(handler, 'miss'), 'services': dict()}
+        for fraction in (0.5, 0.9, 0.99):
+            summary['p{}'.format(int(fraction * 100))] = get_percentile(buckets, fraction)
+        for service in SERVICES:
+            summary['services'][service] = (total(handler, service + '-calls'), total(handler, service + '-us'))
+        metrics.append(summary)
+    metrics.sort(key=lambda summary: -summary['requests'])
+    return metrics
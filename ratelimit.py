@@ -0,0 +1,115 @@
+import logging
+import time
+from google.appengine.api import memcache
+
+
+class RateLimited(Exception):
+    def __init__(self, delay):
+        super(RateLimited, self).__init__('Rate limited for {:.1f}s'.format(delay))
+        self.delay = delay
+
+
+class RateLimiter(object):
+    # Telegram allows ~30 messages/s overall, 1/s to the same private chat and 20/min
+    # to the same group. Counters live in memcache so every instance shares one budget;
+    # each window is a fixed slot keyed by the current second (or minute for groups).
+    NAMESPACE = 'ratelimit'
+
+    GLOBAL_LIMIT = 30
+    GLOBAL_LIMIT_MIN = 5
+    CHAT_LIMIT = 1
+    GROUP_LIMIT = 20
+
+    # after a 429 the global rate is cut back and recovers once this many seconds pass quietly
+    BACKOFF_FACTOR = 0.75
+    BACKOFF_TIME = 5 * 60
+
+    LIMIT_KEY = 'global-limit'
+
+    # window keys are created with an expiry of two windows so they never crowd the devo
+    # and user caches out of memcache
+    SECOND_TTL = 2
+    MINUTE_TTL = 2 * 60
+
+    def acquire(self, uid):
+        return self.acquire_many([uid])[str(uid)]
+
+    def acquire_many(self, uids):
+        # takes a token for every uid that may send now; returns uid -> seconds to wait
+        now = time.time()
+        second = int(now)
+        minute = int(now // 60)
+        uids = [str(uid) for uid in uids]
+        delays = dict((uid, 0) for uid in uids)
+
+        pause_keys = ['pause-' + uid for uid in uids]
+        cached = memcache.get_multi(pause_keys + [self.LIMIT_KEY], namespace=self.NAMESPACE)
+        global_limit = cached.get(self.LIMIT_KEY, self.GLOBAL_LIMIT)
+
+        for uid in uids:
+            pause_until = cached.get('pause-' + uid)
+            if pause_until is not None and pause_until > now:
+                delays[uid] = pause_until - now
+
+        windows = dict()
+        for uid in uids:
+            if delays[uid]:
+                continue
+            if int(uid) < 0:
+                windows['group-{}-{}'.format(uid, minute)] = uid
+            else:
+                windows['chat-{}-{}'.format(uid, second)] = uid
+
+        counts = dict()
+        if windows:
+            chat_keys = [key for key in windows if key.startswith('chat-')]
+            group_keys = [key for key in windows if key.startswith('group-')]
+            if chat_keys:
+                memcache.add_multi(dict((key, 0) for key in chat_keys), time=self.SECOND_TTL,
+                                   namespace=self.NAMESPACE)
+            if group_keys:
+                memcache.add_multi(dict((key, 0) for key in group_keys), time=self.MINUTE_TTL,
+                                   namespace=self.NAMESPACE)
+            counts = memcache.offset_multi(dict((key, 1) for key in windows), namespace=self.NAMESPACE)
+        allowed = list()
+        for key, uid in windows.items():
+            count = counts.get(key)
+            if key.startswith('group-') and count > self.GROUP_LIMIT:
+                delays[uid] = (minute + 1) * 60 - now
+            elif key.startswith('chat-') and count > self.CHAT_LIMIT:
+                delays[uid] = second + 1 - now
+            else:
+                allowed.append(uid)
+
+        if allowed:
+            global_key = 'global-{}'.format(second)
+            memcache.add(global_key, 0, time=self.SECOND_TTL, namespace=self.NAMESPACE)
+            total = memcache.incr(global_key, delta=len(allowed), namespace=self.NAMESPACE) or 0
+            over = total - global_limit
+            if over > 0:
+                for uid in allowed[-over:]:
+                    delays[uid] = second + 1 - now
+
+        return delays
+
+    def penalise(self, uid, retry_after):
+        now = time.time()
+        memcache.set('pause-' + str(uid), now + retry_after, time=int(retry_after) + 1,
+                     namespace=self.NAMESPACE)
+
+        global_limit = memcache.get(self.LIMIT_KEY, namespace=self.NAMESPACE) or self.GLOBAL_LIMIT
+        global_limit = max(self.GLOBAL_LIMIT_MIN, int(global_limit * self.BACKOFF_FACTOR))
+        memcache.set(self.LIMIT_KEY, global_limit, time=self.BACKOFF_TIME, namespace=self.NAMESPACE)
+        logging.info('Rate limited by Telegram for uid {}: pausing {}s, global limit now {}/s'.format(
+            uid, retry_after, global_limit))
+
+    def wait(self, uid, budget):
+        # blocks for short delays; anything longer than the budget is left to the caller
+        while True:
+            delay = self.acquire(uid)
+            if delay <= 0:
+                return
+            if delay > budget:
+                raise RateLimited(delay)
+            budget -= delay
+            time.sleep(delay)
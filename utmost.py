@@ -1,10 +1,15 @@
 # coding=utf-8
 from datetime import datetime, timedelta
 import logging
-from bs4 import BeautifulSoup
-from google.appengine.api import urlfetch, memcache
+from lxml import etree
+from google.appengine.api import apiproxy_stub_map, urlfetch, memcache
 from google.appengine.ext import db
+from formatting import blank_markdown, escape_markdown, is_valid_markdown, sanitise_markdown
+import json
 import re
+import threading
+import time
+from collections import OrderedDict
 
 
 class Material(db.Model):
@@ -25,9 +30,164 @@ def update_material(material, devo):
     material.put()
 
 
+class LocalCache(object):
+    # bounded LRU cache local to this instance; entries carry their own expiry time
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if datetime.utcnow() >= expires:
+                return None
+            self.entries[key] = entry
+            return value
+
+    def set(self, key, value, expires):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, expires)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+def has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' {} ')".format(name)
+
+
+# compiled once; each matches the CSS selector the BeautifulSoup parser used to run
+UTMOST_HEADING = etree.XPath("(//*[{}])[1]".format(has_class('entry-title')))
+UTMOST_KEY_VERSE = etree.XPath("(//*[@id='key-verse-box']/p)[1]")
+UTMOST_KEY_VERSE_LINK = etree.XPath("(//*[@id='key-verse-box']/p/a)[1]")
+UTMOST_POST = etree.XPath("(//*[{}])[1]".format(has_class('post-content')))
+UTMOST_BIBLE_IN_A_YEAR = etree.XPath("(//*[@id='bible-in-a-year-box']/a)[1]")
+# script, style and template contents are kept as their own string types by BeautifulSoup
+# and left out of .text, so they are skipped here too
+TEXT_NODES = etree.XPath("descendant::text()[not(ancestor::script or ancestor::style or ancestor::template)]")
+ASCII_SPACES = u'\x20\x0a\x09\x0c\x0d'
+PRESERVE_WHITESPACE = frozenset(['pre', 'textarea'])
+UTMOST_PARSER = etree.HTMLParser(encoding='utf-8')
+
+
+def keeps_whitespace(text):
+    element = text.getparent()
+    if text.is_tail:
+        element = element.getparent()
+    while element is not None:
+        if element.tag in PRESERVE_WHITESPACE:
+            return True
+        element = element.getparent()
+    return False
+
+
+def collapse_whitespace(text):
+    # BeautifulSoup stores a whitespace-only string as a single newline or space
+    if text.strip(ASCII_SPACES) or keeps_whitespace(text):
+        return text
+    return u'\n' if u'\n' in text else u' '
+
+
+def text_of(element):
+    # every descendant text node, same as BeautifulSoup's .text
+    return u''.join(collapse_whitespace(text) for text in TEXT_NODES(element))
+
+
+PASSAGE_TEXT = etree.XPath("(//*[{}])[1]".format(has_class('passage-text')))
+PASSAGE_TITLE = etree.XPath("(.//*[{}])[1]".format(has_class('passage-display-bcv')))
+PASSAGE_HEADINGS = frozenset(['h1', 'h2', 'h3', 'h4', 'h5', 'h6'])
+PASSAGE_UNWANTED = frozenset(['passage-display', 'footnote', 'footnotes', 'crossrefs', 'publisher-info-bottom'])
+MARKDOWN_CHARS = re.compile(u'[*_`\\[]')
+SUPERSCRIPTS = {u'0': u'\u2070',
+                u'1': u'\xb9',
+                u'2': u'\xb2',
+                u'3': u'\xb3',
+                u'4': u'\u2074',
+                u'5': u'\u2075',
+                u'6': u'\u2076',
+                u'7': u'\u2077',
+                u'8': u'\u2078',
+                u'9': u'\u2079',
+                u'-': u'\u207b'}
+
+
+def to_sup(text):
+    return u''.join(SUPERSCRIPTS.get(char, char) for char in text)
+
+
+def get_classes(element):
+    return (element.get('class') or '').split()
+
+
+def is_unwanted(element):
+    # comments and processing instructions have no text of their own, only a tail
+    if not isinstance(element.tag, basestring):
+        return True
+    return not PASSAGE_UNWANTED.isdisjoint(get_classes(element))
+
+
+def raw_passage_text(element):
+    parts = [element.text or u'']
+    for child in element:
+        if not is_unwanted(child):
+            parts.append(raw_passage_text(child))
+        parts.append(child.tail or u'')
+    return u''.join(parts)
+
+
+def render_passage(element, in_paragraph, blocks):
+    # one walk over the passage tree: returns the rendered text of the element and appends
+    # every heading and paragraph to blocks in document order. Text inside a paragraph is
+    # escaped as it is read; verse and chapter numbers are rendered from that escaped text.
+    tag = element.tag
+    if tag in PASSAGE_HEADINGS:
+        text = '*' + escape_markdown(raw_passage_text(element).strip()) + '*'
+        if in_paragraph:
+            text = escape_markdown(text)
+        blocks.append(text.strip())
+        return text
+    if tag == 'br':
+        return u'\n'
+
+    if tag == 'p':
+        index = len(blocks)
+        blocks.append(None)
+        in_paragraph = True
+
+    def read(text):
+        if not text:
+            return u''
+        return escape_markdown(text) if in_paragraph else text
+
+    parts = [read(element.text)]
+    for child in element:
+        if not is_unwanted(child):
+            parts.append(render_passage(child, in_paragraph, blocks))
+        elif in_paragraph and child.tag is etree.Comment and MARKDOWN_CHARS.search(child.text or u''):
+            # the old escaping pass rewrote these comments as plain text, so they were shown
+            parts.append(escape_markdown(child.text))
+        parts.append(read(child.tail))
+    text = u''.join(parts)
+
+    if tag == 'p':
+        blocks[index] = text.strip()
+        return text
+
+    classes = get_classes(element)
+    if 'chapternum' in classes:
+        text = '*' + escape_markdown(text.strip()) + '*'
+    if 'versenum' in classes:
+        text = to_sup(text.strip())
+    return text
+
+
 # still a java programmer at heart HAHA
 class Utmost_Devo_POJO:
-    def __init(self):
+    def __init__(self):
         # date object storing date for
         self.date = None
         self.heading = None
@@ -109,59 +269,137 @@ class UtmostDevoSource(object):
     TODAY = 0
     TOMORROW = 1
 
+    # devo entries live in a per-generation memcache namespace; the midnight warm-up fills
+    # the next generation and only then moves this pointer, so readers never see a gap
+    GENERATION_KEY = 'devo-generation'
+    CACHE_TIME = 60 * 60 * 48
+
+    # only the request holding a miss's lease scrapes upstream; the rest poll memcache
+    LEASE_TIME = 30
+    LEASE_WAIT = 3
+    LEASE_POLL = 0.5
+    PREPARING = 'Hang on, I\'m still preparing this material. Please try again in a moment :)'
+
+    # 3 deltas x 6 versions are in play at any time; leave room for the day rolling over
+    LOCAL_CACHE_SIZE = 40
+    CACHE_TIERS = ('local', 'memcache', 'datastore', 'upstream')
+
+    def __init__(self):
+        self.local_cache = LocalCache(self.LOCAL_CACHE_SIZE)
+        self.cache_stats = dict((tier, {'hit': 0, 'miss': 0}) for tier in self.CACHE_TIERS)
+
     def strip_markdown(self, string):
-        return string.replace('*', ' ').replace('_', ' ').replace('[', '\[')
+        return blank_markdown(string)
 
-    def get_devo(self, delta=0, version="ESV"):
+    def get_date(self, delta=TODAY):
+        return datetime.utcnow() + timedelta(hours=8, days=delta)
 
-        today_date = datetime.utcnow() + timedelta(hours=8, days=delta)
+    def get_memkey(self, today_date, version):
+        return today_date.strftime("%d-%m-{}".format(version))
 
-        daynames = ['Yesterday\'s', 'Today\'s', 'Tomorrow\'s']
-        devo_dynamic_header = '\xF0\x9F\x93\x85 '.decode("utf-8") + ' ' + daynames[delta + 1]
+    def get_generation(self):
+        generation = memcache.get(self.GENERATION_KEY)
+        if generation is None:
+            memcache.add(self.GENERATION_KEY, 1)
+            generation = memcache.get(self.GENERATION_KEY) or 1
+        return generation
 
-        memkey = today_date.strftime("%d-%m-{}".format(version))
-        devo = memcache.get(memkey)
+    def get_namespace(self, generation=None):
+        if generation is None:
+            generation = self.get_generation()
+        return 'devo-{}'.format(generation)
+
+    def set_generation(self, generation):
+        memcache.set(self.GENERATION_KEY, generation)
+
+    def get_cached_devo(self, memkey, namespace=None):
+        if namespace is None:
+            namespace = self.get_namespace()
+        devo = memcache.get(memkey, namespace=namespace)
+        self.__count('memcache', devo is not None)
 
         if devo is not None:
             logging.info("memkey {} hit. Returning...".format(memkey))
-            return devo_dynamic_header + devo
+            return devo
 
         material = get_material(memkey)
+        self.__count('datastore', material.text is not None)
 
         if material.text is not None:
             logging.info("datastore {} hit. Returning...".format(memkey))
-            memcache.set(memkey, material.text)
-            return devo_dynamic_header + material.text
+            memcache.set(memkey, material.text, time=self.CACHE_TIME, namespace=namespace)
+            return material.text
 
-        # lazy init
-        self.devo_object = Utmost_Devo_POJO()
+        return None
 
-        try:
-            result = urlfetch.fetch(self.base_devo_url(today_date.month, today_date.day), follow_redirects=True,
-                                    deadline=10)
-        except Exception as e:
-            logging.warning('Error fetching devo:\n' + str(e))
-            return None
+    def get_cache_stats(self):
+        return dict((tier, dict(counts)) for tier, counts in self.cache_stats.items())
 
-        try:
-            parse_status = self.__parse_utmost_org(result.content, today_date)
+    def __count(self, tier, hit):
+        self.cache_stats[tier]['hit' if hit else 'miss'] += 1
+
+    def __get_local_expiry(self):
+        # the next Singapore midnight, i.e. tomorrow's get_today_time()
+        today = (datetime.utcnow() + timedelta(hours=8)).date()
+        return datetime(today.year, today.month, today.day) + timedelta(hours=16)
+
+    def get_header(self, delta=TODAY):
+        daynames = ['Yesterday\'s', 'Today\'s', 'Tomorrow\'s']
+        return '\xF0\x9F\x93\x85 '.decode("utf-8") + ' ' + daynames[delta + 1]
+
+    def peek_devo(self, delta=0, version="ESV"):
+        # cache-only lookup that never touches the datastore or upstream
+        memkey = self.get_memkey(self.get_date(delta), version)
+        devo = self.local_cache.get(memkey)
+        if devo is None:
+            devo = memcache.get(memkey, namespace=self.get_namespace())
+            if devo is None:
+                return None
+            self.local_cache.set(memkey, devo, self.__get_local_expiry())
+        return self.get_header(delta) + devo
+
+    def get_devo(self, delta=0, version="ESV"):
+
+        today_date = self.get_date(delta)
+        devo_dynamic_header = self.get_header(delta)
+
+        memkey = self.get_memkey(today_date, version)
+        devo = self.local_cache.get(memkey)
+        self.__count('local', devo is not None)
+
+        if devo is not None:
+            logging.debug("local {} hit. Returning...".format(memkey))
+            return devo_dynamic_header + devo
+
+        namespace = self.get_namespace()
+        devo = self.get_cached_devo(memkey, namespace)
+
+        if devo is not None:
+            self.local_cache.set(memkey, devo, self.__get_local_expiry())
+            return devo_dynamic_header + devo
 
-            def replaceDefaultVersion(url, newVersion):
-                default = 31
-                versionFormat = "version={}".format
-                defaultVersionString = versionFormat(default)
-                newVersionString = versionFormat(newVersion)
+        if not self.__acquire_lease(memkey, namespace):
+            devo = self.__wait_for_lease(memkey, namespace)
+            if devo is None:
+                return self.PREPARING
+            return devo_dynamic_header + devo
 
-                return url.replace(defaultVersionString, newVersionString)
+        try:
+            return self.__fetch_devo(today_date, delta, version, memkey, namespace, devo_dynamic_header)
+        finally:
+            self.__release_lease(memkey, namespace)
 
-            self.devo_object.link_to_full_verse_bgw = replaceDefaultVersion(self.devo_object.link_to_full_verse_bgw,
-                                                                            version)
-            self.devo_object.bible_in_a_year = replaceDefaultVersion(self.devo_object.bible_in_a_year, version)
+    def __fetch_devo(self, today_date, delta, version, memkey, namespace, devo_dynamic_header):
+        self.devo_object = self.get_utmost_devo(today_date, namespace)
+        if self.devo_object is None:
+            return None
+        if self.devo_object is self.PREPARING:
+            return self.PREPARING
 
-            logging.debug("link_to_full_verse__bgw : {}".format(self.devo_object.link_to_full_verse_bgw))
-            logging.debug("bible in a year : {}".format(self.devo_object.bible_in_a_year))
+        try:
+            self.__localise_links(self.devo_object, version)
 
-            if not parse_status:
+            if not self.devo_object.is_utmost_parse_success():
                 logging.warning('Error parseing devo:\n')
 
                 if delta == self.YESTERDAY:
@@ -178,50 +416,238 @@ class UtmostDevoSource(object):
             result = urlfetch.fetch(self.devo_object.link_to_full_verse_bgw, deadline=10)
         except Exception as e:
             logging.warning('Error fetching verse:\n' + str(e))
+            self.__count('upstream', False)
             return None
+        self.__count('upstream', True)
 
         try:
-            self.devo_object.link_to_full_verse_yv = self.__get_youversion_link(verse_ref=self.devo_object.verse_reference,
-                                                                                version=version)
-
-            parse_status = self.__parse_biblegateway_com(result.content)
-
-
-
-            logging.info("Parsing Success:: All content parsed successfuly.")
-            final_devo = self.devo_object.format_to_message(version_abbv=version)
+            final_devo = self.__render_devo(self.devo_object, version, result.content)
         except Exception as e:
             logging.warning('Error parsing verse:\n' + str(e))
             return None
-        # cache
-        if self.STORE_CACHE:
-            logging.debug("Storing devo in memcache & db {}".format(memkey))
-            memcache.set(memkey, final_devo)
-            update_material(material, final_devo)
+
+        self.__store_devo(memkey, final_devo, namespace)
 
         return devo_dynamic_header + final_devo
 
     def get_devo_old(self, delta=TODAY):
         pass
 
+    def warm_cache(self, deltas, versions, generation=None):
+        # fetches every missing utmost.org page and biblegateway passage concurrently,
+        # starting a day's passages as soon as its utmost.org page arrives
+        namespace = self.get_namespace(generation)
+        report = list()
+        pending = dict()
+
+        def fetch_passages(today_date, fields, missing):
+            for version in missing:
+                memkey = self.get_memkey(today_date, version)
+                devo_object = self.__to_devo_object(fields)
+                try:
+                    self.__localise_links(devo_object, version)
+                    rpc = urlfetch.create_rpc(deadline=10)
+                    urlfetch.make_fetch_call(rpc, devo_object.link_to_full_verse_bgw)
+                except Exception as e:
+                    report.append((memkey, 'failed - ' + str(e)))
+                    continue
+                pending[rpc] = (memkey, version, devo_object)
+
+        for delta in deltas:
+            today_date = self.get_date(delta)
+            missing = [version for version in versions
+                       if self.get_cached_devo(self.get_memkey(today_date, version), namespace) is None]
+            for version in versions:
+                if version not in missing:
+                    report.append((self.get_memkey(today_date, version), 'cached'))
+            if not missing:
+                continue
+
+            fields = self.__get_cached_utmost(today_date, namespace)
+            if fields is not None:
+                fetch_passages(today_date, fields, missing)
+                continue
+
+            rpc = urlfetch.create_rpc(deadline=10)
+            urlfetch.make_fetch_call(rpc, self.base_devo_url(today_date.month, today_date.day),
+                                     follow_redirects=True)
+            pending[rpc] = (today_date, missing)
+
+        while pending:
+            rpc = apiproxy_stub_map.UserRPC.wait_any(pending.keys())
+            item = pending.pop(rpc)
+
+            if isinstance(item[0], datetime):
+                today_date, missing = item
+                try:
+                    devo_object = self.__build_utmost(today_date, rpc.get_result().content, namespace)
+                except Exception as e:
+                    logging.warning('Error fetching devo:\n' + str(e))
+                    devo_object = None
+                if devo_object is None:
+                    for version in missing:
+                        report.append((self.get_memkey(today_date, version), 'failed - utmost.org'))
+                    continue
+                fetch_passages(today_date, dict(devo_object.__dict__), missing)
+                continue
+
+            memkey, version, devo_object = item
+            try:
+                final_devo = self.__render_devo(devo_object, version, rpc.get_result().content)
+            except Exception as e:
+                logging.warning('Error fetching verse:\n' + str(e))
+                report.append((memkey, 'failed - ' + str(e)))
+                continue
+            self.__store_devo(memkey, final_devo, namespace)
+            report.append((memkey, 'fetched'))
+
+        return report
+
+    def get_utmost_devo(self, today_date, namespace=None):
+        # the utmost.org reflection is the same for every version, so it is scraped
+        # once per day and cached on its own; only the passage is fetched per version
+        if namespace is None:
+            namespace = self.get_namespace()
+        fields = self.__get_cached_utmost(today_date, namespace)
+        if fields is not None:
+            return self.__to_devo_object(fields)
+
+        memkey = today_date.strftime("utmost-%d-%m")
+        if not self.__acquire_lease(memkey, namespace):
+            fields = self.__wait_for_lease(memkey, namespace)
+            if fields is None:
+                return self.PREPARING
+            return self.__to_devo_object(fields)
+
+        try:
+            result = urlfetch.fetch(self.base_devo_url(today_date.month, today_date.day), follow_redirects=True,
+                                    deadline=10)
+            return self.__build_utmost(today_date, result.content, namespace)
+        except Exception as e:
+            logging.warning('Error fetching devo:\n' + str(e))
+            return None
+        finally:
+            self.__release_lease(memkey, namespace)
+
+    def __acquire_lease(self, memkey, namespace):
+        if memcache.add('lease-' + memkey, True, time=self.LEASE_TIME, namespace=namespace):
+            return True
+        # add also fails when memcache is unavailable; only wait on a lease we can see
+        if memcache.get('lease-' + memkey, namespace=namespace) is None:
+            logging.warning("Could not check lease for memkey {}, fetching it here".format(memkey))
+            return True
+        return False
+
+    def __release_lease(self, memkey, namespace):
+        memcache.delete('lease-' + memkey, namespace=namespace)
+
+    def __wait_for_lease(self, memkey, namespace):
+        logging.info("memkey {} is being fetched elsewhere. Waiting...".format(memkey))
+        waited = 0
+        while waited < self.LEASE_WAIT:
+            time.sleep(self.LEASE_POLL)
+            waited += self.LEASE_POLL
+            value = memcache.get(memkey, namespace=namespace)
+            if value is not None:
+                return value
+        return None
+
+    def __get_cached_utmost(self, today_date, namespace):
+        memkey = today_date.strftime("utmost-%d-%m")
+        fields = memcache.get(memkey, namespace=namespace)
+
+        if fields is not None:
+            logging.info("memkey {} hit. Returning...".format(memkey))
+            return fields
+
+        material = get_material(memkey)
+        if material.text is not None:
+            logging.info("datastore {} hit. Returning...".format(memkey))
+            fields = json.loads(material.text)
+            memcache.set(memkey, fields, time=self.CACHE_TIME, namespace=namespace)
+
+        return fields
+
+    def __build_utmost(self, today_date, html, namespace):
+        memkey = today_date.strftime("utmost-%d-%m")
+        devo_object = Utmost_Devo_POJO()
+        self.devo_object = devo_object
+        self.__parse_utmost_org(html, today_date)
+
+        if self.STORE_CACHE and devo_object.is_utmost_parse_success():
+            logging.debug("Storing utmost devo in memcache & db {}".format(memkey))
+            fields = dict(devo_object.__dict__)
+            memcache.set(memkey, fields, time=self.CACHE_TIME, namespace=namespace)
+            update_material(Material(key_name=memkey), json.dumps(fields))
+
+        return devo_object
+
+    def __to_devo_object(self, fields):
+        devo_object = Utmost_Devo_POJO()
+        devo_object.__dict__.update(fields)
+        return devo_object
+
+    def __localise_links(self, devo_object, version):
+        def replaceDefaultVersion(url, newVersion):
+            default = 31
+            versionFormat = "version={}".format
+            defaultVersionString = versionFormat(default)
+            newVersionString = versionFormat(newVersion)
+
+            return url.replace(defaultVersionString, newVersionString)
+
+        devo_object.link_to_full_verse_bgw = replaceDefaultVersion(devo_object.link_to_full_verse_bgw, version)
+        devo_object.bible_in_a_year = replaceDefaultVersion(devo_object.bible_in_a_year, version)
+
+        logging.debug("link_to_full_verse__bgw : {}".format(devo_object.link_to_full_verse_bgw))
+        logging.debug("bible in a year : {}".format(devo_object.bible_in_a_year))
+
+    def __render_devo(self, devo_object, version, html):
+        self.devo_object = devo_object
+        devo_object.link_to_full_verse_yv = self.__get_youversion_link(verse_ref=devo_object.verse_reference,
+                                                                       version=version)
+
+        self.__parse_biblegateway_com(html)
+
+        logging.info("Parsing Success:: All content parsed successfuly.")
+        devo = devo_object.format_to_message(version_abbv=version)
+
+        # validate once here so every cached copy is known to parse
+        if not is_valid_markdown(devo):
+            logging.warning("Sanitising markdown for {}".format(version))
+            devo = sanitise_markdown(devo)
+        return devo
+
+    def __store_devo(self, memkey, final_devo, namespace):
+        if self.STORE_CACHE:
+            logging.debug("Storing devo in memcache & db {}".format(memkey))
+            memcache.set(memkey, final_devo, time=self.CACHE_TIME, namespace=namespace)
+            update_material(Material(key_name=str(memkey)), final_devo)
+            self.local_cache.set(memkey, final_devo, self.__get_local_expiry())
+
     def __parse_utmost_org(self, html, today_date):
 
         logging.debug("Starting to parse utmost.org::")
         try:
-            soup = BeautifulSoup(html, 'lxml')
+            root = etree.HTML(html, UTMOST_PARSER)
+
+            def first(xpath):
+                return xpath(root)[0]
 
             date = today_date.strftime('%b %d, %Y ({})').format(today_date.strftime('%a').upper())
-            heading = soup.select_one('.entry-title').text.strip()
-            verse_consise = soup.select_one('#key-verse-box > p').text
+            heading = text_of(first(UTMOST_HEADING)).strip()
+            verse_consise = text_of(first(UTMOST_KEY_VERSE))
             demarc = verse_consise.index("—".decode("utf-8"))
             verse_consise = verse_consise[:demarc]
-            verse_reference = soup.select_one('#key-verse-box > p > a').text
-            post = self.strip_markdown(soup.select_one('.post-content').text.replace("\n", "\n\n"))
-            link_to_verse = soup.select_one('#key-verse-box > p > a').get("href").strip()
+            verse_link = first(UTMOST_KEY_VERSE_LINK)
+            verse_reference = text_of(verse_link)
+            post = self.strip_markdown(text_of(first(UTMOST_POST)).replace("\n", "\n\n"))
+            link_to_verse = verse_link.get("href").strip()
 
-            bible_in_a_year = soup.select_one('#bible-in-a-year-box > a').get("href").strip()
-            bible_in_a_year_text = "[" + soup.select_one('#bible-in-a-year-box > a').text.replace("; ",
-                                                                                                  "\n") + "](" + bible_in_a_year + ")"
+            bible_in_a_year_link = first(UTMOST_BIBLE_IN_A_YEAR)
+            bible_in_a_year = bible_in_a_year_link.get("href").strip()
+            bible_in_a_year_text = "[" + text_of(bible_in_a_year_link).replace("; ",
+                                                                               "\n") + "](" + bible_in_a_year + ")"
 
             self.devo_object.date = date
             self.devo_object.heading = heading
@@ -241,86 +667,28 @@ class UtmostDevoSource(object):
 
     def __parse_biblegateway_com(self, html):
         # stole this code from @biblegatewaybot
-        def strip_markdown(string):
-            return string.replace('*', '\*').replace('_', '\_').replace('`', '\`').replace('[', '\[')
-
         EMPTY = "empty"
 
-        def to_sup(text):
-            sups = {u'0': u'\u2070',
-                    u'1': u'\xb9',
-                    u'2': u'\xb2',
-                    u'3': u'\xb3',
-                    u'4': u'\u2074',
-                    u'5': u'\u2075',
-                    u'6': u'\u2076',
-                    u'7': u'\u2077',
-                    u'8': u'\u2078',
-                    u'9': u'\u2079',
-                    u'-': u'\u207b'}
-            return ''.join(sups.get(char, char) for char in text)
-
         start = html.find('<div class="passage-text">')
         if start == -1:
             return EMPTY
         end = html.find('<!--END .passage-text-->', start)
         passage_html = html[start:end]
 
-        soup = BeautifulSoup(passage_html, 'lxml').select_one('.passage-text')
-
-        WANTED = 'bg-bot-passage-text'
-        UNWANTED = '.passage-display, .footnote, .footnotes, .crossrefs, .publisher-info-bottom'
-
-        title = soup.select_one('.passage-display-bcv').text
+        passage = PASSAGE_TEXT(etree.HTML(passage_html, UTMOST_PARSER))[0]
+        title = text_of(PASSAGE_TITLE(passage)[0])
 
         def getVerseHref():
             return self.devo_object.link_to_full_verse_yv if self.devo_object.link_to_full_verse_yv is not None else self.devo_object.link_to_full_verse_bgw
 
-        header = '[' + strip_markdown(title.strip()) + '](' + getVerseHref() + ')'
-
-        for tag in soup.select(UNWANTED):
-            tag.decompose()
-
-        for tag in soup.select('h1, h2, h3, h4, h5, h6'):
-            tag['class'] = WANTED
-            text = tag.text.strip()
-            tag.string = '*' + strip_markdown(text) + '*'
-
-        needed_stripping = False
-
-        for tag in soup.select('p'):
-            tag['class'] = WANTED
-            bad_strings = tag(text=re.compile('(\*|\_|\`|\[)'))
-            for bad_string in bad_strings:
-                stripped_text = strip_markdown(unicode(bad_string))
-                bad_string.replace_with(stripped_text)
-                needed_stripping = True
-
-        if needed_stripping:
-            logging.info('Stripped markdown')
-
-        for tag in soup.select('br'):
-            tag.name = 'span'
-            tag.string = '\n'
-
-        for tag in soup.select('.chapternum'):
-            num = tag.text.strip()
-            tag.string = '*' + strip_markdown(num) + '*'
-
-        for tag in soup.select('.versenum'):
-            num = tag.text.strip()
-            tag.string = to_sup(num)
-
-        for tag in soup.select('.text'):
-            tag.string = tag.text.rstrip()
+        header = '[' + escape_markdown(title.strip()) + '](' + getVerseHref() + ')'
 
-        final_text = header + '\n'
-        for tag in soup(class_=WANTED):
-            final_text += tag.text.strip() + '\n\n'
+        blocks = list()
+        render_passage(passage, False, blocks)
 
-        logging.debug('Finished BeautifulSoup processing')
+        logging.debug('Finished passage processing')
 
-        self.devo_object.verse_full = final_text.strip()
+        self.devo_object.verse_full = (header + u'\n' + u''.join(block + u'\n\n' for block in blocks)).strip()
         return
 
     def __get_youversion_link(self, verse_ref, version):